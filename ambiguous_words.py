@@ -0,0 +1,76 @@
+"""
+Words WordNet has more than one meaning for, which remove_synonyms takes out of
+names.
+
+Asking WordNet means loading it and lemmatizing each word, so the words are
+found once, saved to data/ambiguous_words.txt, and only read after that, so
+runs don't need WordNet at all. Build them (e.g. after checking out, or after
+updating WordNet) with
+
+    python -m ambiguous_words
+
+Runs that get to remove_synonyms without them raise AmbiguousWordsMissing.
+"""
+
+import os
+from functools import lru_cache
+from typing import Any, FrozenSet, Iterable, Iterator
+from nltk_models import models
+
+AMBIGUOUS_WORDS_FILE = "data/ambiguous_words.txt"
+
+
+class AmbiguousWordsMissing(LookupError):
+    pass
+
+
+def lemmatizable_words(wordnet: Any) -> Iterator[str]:
+    """
+    The words wordnet.synsets finds something for by lemmatizing them once: the
+    lemmas, the exceptions (e.g. geese), and the lemmas with any of the endings
+    the lemmatizer strips (e.g. dogs).
+
+    wordnet.synsets keeps stripping endings until it finds a lemma, so "dogss"
+    has the synsets of "dog" too, but nothing like that turns up in names.
+    """
+    for pos, substitutions in wordnet.MORPHOLOGICAL_SUBSTITUTIONS.items():
+        for lemma in wordnet.all_lemma_names(pos):
+            yield lemma
+            for ending, replacement in substitutions:
+                if lemma.endswith(replacement):
+                    yield lemma[: len(lemma) - len(replacement)] + ending
+        yield from wordnet._exception_map[pos]  # pylint: disable=protected-access
+
+
+def build() -> FrozenSet[str]:
+    wordnet = models.wordnet()
+    return frozenset(
+        word
+        for word in set(lemmatizable_words(wordnet))
+        if len(wordnet.synsets(word)) > 1
+    )
+
+
+def save(words: Iterable[str], file_name: str = AMBIGUOUS_WORDS_FILE) -> None:
+    # workers that each build the words don't write over each other's
+    temp_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(temp_name, "w", encoding="utf-8") as words_file:
+        words_file.write("\n".join(sorted(words)))
+    os.replace(temp_name, file_name)
+
+
+@lru_cache(maxsize=None)
+def ambiguous_words(file_name: str = AMBIGUOUS_WORDS_FILE) -> FrozenSet[str]:
+    "Lowercase, like wordnet.synsets looks them up"
+    try:
+        with open(file_name, encoding="utf-8") as words_file:
+            return frozenset(words_file.read().split())
+    except FileNotFoundError:
+        raise AmbiguousWordsMissing(
+            f"{file_name} is missing, build it with: python -m ambiguous_words"
+        ) from None
+
+
+if __name__ == "__main__":
+    save(build())
+    print(f"saved {len(ambiguous_words())} words to {AMBIGUOUS_WORDS_FILE}")
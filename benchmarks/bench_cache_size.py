@@ -0,0 +1,110 @@
+"""
+Size of the cache for the same results with and without hash_keys: the log, the
+snapshot (with and without shared results) and the overlay in memory. The
+results are made up but shaped like the real ones, several functions' worth of
+names for each line. Uses the same rows as bench_contacts, and then longer ones
+made by joining them, since the longer the lines, the more hashing saves.
+
+Hashing and sharing only save disk. Last measured, hashing cut the log and
+snapshot by 30% on 45 character rows and 70% on 455 character ones, and
+sharing took another 4-12% off snapshots, but the overlay grew from 5,101 to
+5,431 kB and from 2,123 to 2,156 kB. Nothing shares or interns results in the
+overlay or the log.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_cache_size
+"""
+
+import os
+import tempfile
+import tracemalloc
+from typing import Callable, List
+from cache import Cache, Snapshot, record_size
+from benchmarks.bench_contacts import load_rows
+
+
+def capitalized(line: str) -> List[str]:
+    return [word for word in line.split() if word[:1].isupper()]
+
+
+def make_funcs(cache: Cache) -> List[Callable]:
+    "Stand-ins for the cached strategies, with the same names"
+
+    def nltk_extract_names(line: str) -> List[str]:
+        return capitalized(line)[:2]
+
+    def google_extract_names_no_preprocess(line: str) -> List[str]:
+        return capitalized(line)
+
+    def google_extract_names_only_alpha(line: str) -> List[str]:
+        return capitalized(line)
+
+    def google_extract_names_every_name(line: str) -> List[str]:
+        return capitalized(line)[1:]
+
+    def only_alpha(line: str) -> str:
+        return " ".join(word for word in line.split() if word.isalpha())
+
+    def every_name(line: str) -> str:
+        return " ".join(capitalized(line))
+
+    return [
+        cache.with_cache(func)
+        for func in [
+            nltk_extract_names,
+            google_extract_names_no_preprocess,
+            google_extract_names_only_alpha,
+            google_extract_names_every_name,
+            only_alpha,
+            every_name,
+        ]
+    ]
+
+
+def measure(rows: List[str], hash_keys: bool) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        cache = Cache(
+            os.path.join(directory, "cache.json"),
+            compact_after=len(rows) * 10,
+            hash_keys=hash_keys,
+        )
+        funcs = make_funcs(cache)
+        with cache:
+            tracemalloc.start()
+            for row in rows:
+                for func in funcs:
+                    func(row)
+            overlay_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            log_bytes = os.path.getsize(cache.log_name)
+            cache.start_compaction()
+        snapshot_bytes = os.path.getsize(cache.snapshot_name)
+        snapshot = Snapshot(cache.snapshot_name)
+        unshared_bytes = (
+            Snapshot.HEADER.size
+            + sum(record_size(key, len(value)) for key, value in snapshot)
+            + snapshot.slots * Snapshot.SLOT.size
+        )
+    print(
+        f"hash_keys={hash_keys!s:<5} log {log_bytes / 1e3:8,.0f} kB, "
+        f"snapshot {snapshot_bytes / 1e3:8,.0f} kB "
+        f"({unshared_bytes / 1e3:,.0f} kB without sharing), "
+        f"overlay {overlay_bytes / 1e3:8,.0f} kB"
+    )
+
+
+def main() -> None:
+    rows = load_rows()
+    long_rows = [" ".join(rows[i : i + 10]) for i in range(0, len(rows), 10)]
+    for some_rows in [rows, long_rows]:
+        print(
+            f"{len(some_rows)} rows, "
+            f"{sum(map(len, some_rows)) / len(some_rows):,.0f} characters on average"
+        )
+        for hash_keys in [False, True]:
+            measure(some_rows, hash_keys)
+
+
+if __name__ == "__main__":
+    main()
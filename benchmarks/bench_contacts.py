@@ -0,0 +1,90 @@
+"""
+Rows per second for extract_contacts, with and without skipping lines that
+can't have a phone number, checking that both find the same contacts. Uses
+data/trello.csv if it's there, or generated rows otherwise. Run from the
+repository root:
+
+    python -m benchmarks.bench_contacts
+"""
+
+import csv
+import json
+import random
+import time
+from typing import Callable, List, Tuple
+from phonenumbers import PhoneNumberMatcher, format_number, PhoneNumberFormat
+from extract_info import EMAIL_RE, extract_contacts
+
+PHONES = [
+    "617.555.5555",
+    "(603) 750-0001",
+    "603-750-0001 x 119",
+    "+44 20 7946 0958",
+    "+43 1 5331234",
+    "1-800-555-0199",
+]
+WORDS = "Lisa balloon drop off paid check deposited Planet Fitness McCall cr card"
+
+
+def unfiltered_extract_contacts(line: str) -> Tuple[List[str], List[str]]:
+    "extract_contacts before the prefilter"
+    emails = EMAIL_RE.findall(line)
+    phones = [
+        format_number(match.number, PhoneNumberFormat.INTERNATIONAL)
+        for match in PhoneNumberMatcher(line, "US")
+    ]
+    return emails, phones
+
+
+def generate_rows(count: int, rng: random.Random) -> List[str]:
+    "Like trello cards: a date, some words, maybe a price, a phone or an email"
+    rows = []
+    for _ in range(count):
+        parts = [f"{rng.randint(1, 12)}/{rng.randint(1, 31)}"]
+        parts += rng.sample(WORDS.split(), rng.randint(2, 8))
+        if rng.random() < 0.4:
+            parts.append(f"${rng.randint(5, 500)}")
+        if rng.random() < 0.3:
+            parts.append(rng.choice(PHONES))
+        if rng.random() < 0.2:
+            parts.append(f"{rng.choice(WORDS.split()).lower()}@example.com")
+        rows.append(" ".join(parts))
+    return rows
+
+
+def load_rows() -> List[str]:
+    rows: List[str] = []
+    try:
+        with open("data/trello.csv", encoding="utf-8") as in_file:
+            rows = [row[0] for row in list(csv.reader(in_file))[1:]]
+    except FileNotFoundError:
+        pass
+    try:
+        with open("data/examples.json", encoding="utf-8") as examples_file:
+            rows += [example["line"][0] for example in json.load(examples_file)]
+    except FileNotFoundError:
+        pass
+    return rows or generate_rows(5000, random.Random(0))
+
+
+def rows_per_second(extract: Callable, rows: List[str]) -> float:
+    start = time.perf_counter()
+    for row in rows:
+        extract(row)
+    return len(rows) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    rows = load_rows()
+    for row in rows:
+        assert extract_contacts(row) == unfiltered_extract_contacts(row), row
+    print(f"same contacts for all {len(rows)} rows")
+    for name, extract in [
+        ("before", unfiltered_extract_contacts),
+        ("after", extract_contacts),
+    ]:
+        print(f"{name:>6}: {rows_per_second(extract, rows):,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Check fuzzy_intersect against the recursive implementation it replaced and time
+both on generated name lists. Run from the repository root:
+
+    python -m benchmarks.bench_fuzzy_intersect
+
+The recursive version set aside names with sets, so the order it took the rest
+of the names in, and sometimes which names it returned, depended on string
+hashing: on these lists, two runs with different PYTHONHASHSEEDs only agree
+about half the time. reference_fuzzy_intersect is the same algorithm with
+insertion ordered sets, which the current version has to match exactly.
+"""
+
+import random
+import string
+import timeit
+from typing import List, Optional
+import extract_info
+from extract_info import fuzzy_intersect
+
+Names = List[str]
+
+FIRST_NAMES = ["Ann", "Bob", "Cy", "Lisa", "Miller", "Kochi", "Pierre", "McCall"]
+
+
+def recursive_fuzzy_intersect(
+    left: Names, right: Names, recursive: bool = False
+) -> Names:
+    if recursive:
+        if not left:
+            return []
+    else:
+        if not (left and right):
+            return left or right
+    first_left, *remaining_left = left
+    similar_right = set(
+        right_name
+        for right_name in right
+        if right_name in first_left or first_left in right_name
+    )
+    if similar_right:
+        also_similar_left = set(
+            left_name
+            for left_name in remaining_left
+            if left_name in first_left or first_left in left_name
+        )
+        intersection = max(first_left, *similar_right, *also_similar_left, key=len)
+        dissimilar_right = list(set(right) - similar_right)
+        dissimilar_left = list(set(remaining_left) - also_similar_left)
+        return [intersection] + recursive_fuzzy_intersect(
+            dissimilar_left, dissimilar_right, True
+        )
+    return recursive_fuzzy_intersect(remaining_left, right, recursive=True)
+
+
+def reference_fuzzy_intersect(left: Names, right: Names) -> Names:
+    if not (left and right):
+        return left or right
+    remaining_left, remaining_right = list(dict.fromkeys(left)), list(right)
+    intersection = []
+    while remaining_left:
+        first_left, *remaining_left = remaining_left
+        similar_right = [
+            name
+            for name in dict.fromkeys(remaining_right)
+            if name in first_left or first_left in name
+        ]
+        if similar_right:
+            also_similar_left = [
+                name
+                for name in remaining_left
+                if name in first_left or first_left in name
+            ]
+            intersection.append(
+                max(first_left, *similar_right, *also_similar_left, key=len)
+            )
+            remaining_right = [
+                name for name in remaining_right if name not in similar_right
+            ]
+            remaining_left = [
+                name for name in remaining_left if name not in also_similar_left
+            ]
+    return intersection
+
+
+def generate_names(count: int, rng: random.Random) -> Names:
+    "Mostly first names and full names that overlap, with some random words"
+    names = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            names.append(rng.choice(FIRST_NAMES))
+        elif kind < 0.7:
+            names.append(" ".join(rng.sample(FIRST_NAMES, 2)))
+        else:
+            letters = rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))
+            names.append("".join(letters).capitalize())
+    return names
+
+
+def check_equivalence(trials: int, rng: random.Random) -> None:
+    agreed = 0
+    for _ in range(trials):
+        left = generate_names(rng.randint(0, 40), rng)
+        right = generate_names(rng.randint(0, 40), rng)
+        expected = reference_fuzzy_intersect(left, right)
+        assert fuzzy_intersect(left, right) == expected, (left, right)
+        # and with the index, whatever the size
+        index_min_names = extract_info.FUZZY_INDEX_MIN_NAMES
+        extract_info.FUZZY_INDEX_MIN_NAMES = 0
+        try:
+            assert fuzzy_intersect(left, right) == expected, (left, right)
+        finally:
+            extract_info.FUZZY_INDEX_MIN_NAMES = index_min_names
+        agreed += sorted(recursive_fuzzy_intersect(left, right)) == sorted(expected)
+    print(f"{trials} random lists match the reference")
+    print(f"{agreed / trials:.1%} also match the recursive version, up to order")
+
+
+def time_per_call(func: str, left: Names, right: Names) -> Optional[float]:
+    number = max(1, 20000 // (len(left) + len(right)))
+    try:
+        total = timeit.timeit(
+            f"{func}(left, right)", globals={**globals(), **locals()}, number=number
+        )
+    except RecursionError:
+        return None
+    return total / number
+
+
+def main() -> None:
+    rng = random.Random(0)
+    check_equivalence(2000, rng)
+    print(f"{'names':>6} {'recursive':>12} {'current':>12}")
+    for count in [5, 20, 50, 200, 1000, 5000]:
+        left, right = generate_names(count, rng), generate_names(count, rng)
+        times = [
+            time_per_call(func, left, right)
+            for func in ["recursive_fuzzy_intersect", "fuzzy_intersect"]
+        ]
+        print(
+            f"{count:>6}",
+            *(
+                f"{time * 1e3:>10.3f}ms" if time is not None else f"{'recursion':>12}"
+                for time in times
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
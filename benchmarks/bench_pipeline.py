@@ -0,0 +1,177 @@
+"""
+Run extract_info over synthetic records (see corpus) with a local stand-in for
+the Google API (see language_stub), first with an empty cache and then again
+with the cache it filled. For each run, report rows per second, p50 and p99
+latency per line, time spent in each stage and peak RSS. Each run is in its own
+process, so peak RSS is that run's. Run from the repository root, e.g.
+
+    python -m benchmarks.bench_pipeline --rows 1000 10000 --save baseline.json
+    python -m benchmarks.bench_pipeline --rows 1000 10000 --compare baseline.json
+
+--save writes the results as JSON. --compare prints the change from results
+saved earlier, for the runs both have.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Sequence, Tuple
+import language_api
+from language_api import LanguageClient
+from language_stub import LanguageStub
+from cache import cache
+from nltk_models import models
+from ambiguous_words import ambiguous_words
+from strategies import STAGES, STAGE_NAMES
+from strategy_stats import strategy_stats
+from extract_info import parse_line, extract_parsed_info
+from benchmarks.corpus import generate_records
+
+
+@dataclass
+class BenchmarkResult:
+    rows: int
+    cache: str
+    rows_per_second: float
+    p50_ms: float
+    p99_ms: float
+    # parsing, each stage of strategies, and everything else in extract_names
+    stage_seconds: Dict[str, float]
+    peak_rss_mb: float
+
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    index = int(fraction * len(sorted_values))
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return peak / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+def run(
+    rows: int, warm: bool, cache_name: str, seed: int, latency: float
+) -> BenchmarkResult:
+    lines = list(generate_records(rows, seed))
+    cache.move(cache_name)
+    latencies: List[float] = []
+    parse_seconds = 0.0
+    with LanguageStub(latency) as stub, cache, open(os.devnull, "w") as devnull:
+        # the stub isn't rate limited
+        language_api.client = LanguageClient(
+            discovery_url=stub.discovery_url, requests_per_second=1e9, burst=1000
+        )
+        models.warm_up()
+        ambiguous_words()
+        strategy_stats.pop_new_records()
+        with contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for line in lines:
+                line_start = time.perf_counter()
+                parsed = parse_line(line)
+                parsed_time = time.perf_counter()
+                extract_parsed_info(parsed)
+                line_end = time.perf_counter()
+                parse_seconds += parsed_time - line_start
+                latencies.append(line_end - line_start)
+            elapsed = time.perf_counter() - start
+    records = strategy_stats.pop_new_records()
+    stage_seconds = {"parse": parse_seconds}
+    for stage_name, stage in zip(STAGE_NAMES, STAGES):
+        stage_seconds[stage_name] = sum(
+            records[strategy.__name__].time
+            for strategy in stage
+            if strategy.__name__ in records
+        )
+    stage_seconds["other"] = elapsed - sum(stage_seconds.values())
+    latencies.sort()
+    return BenchmarkResult(
+        rows,
+        "warm" if warm else "cold",
+        rows / elapsed,
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        stage_seconds,
+        peak_rss_mb(),
+    )
+
+
+def run_in_process(*args: Any) -> BenchmarkResult:
+    with ProcessPoolExecutor(1) as executor:
+        return executor.submit(run, *args).result()
+
+
+def print_result(result: BenchmarkResult, baseline: Dict[str, Any]) -> None:
+    def change(key: str) -> str:
+        if key not in baseline:
+            return ""
+        return " ({:+.0%})".format(getattr(result, key) / baseline[key] - 1)
+
+    stages = ", ".join(
+        f"{stage} {seconds:.2f}s" for stage, seconds in result.stage_seconds.items()
+    )
+    print(
+        f"{result.rows:>8} rows, {result.cache}: "
+        f"{result.rows_per_second:,.0f} rows/s{change('rows_per_second')}, "
+        f"p50 {result.p50_ms:.2f}ms{change('p50_ms')}, "
+        f"p99 {result.p99_ms:.2f}ms{change('p99_ms')}, "
+        f"peak RSS {result.peak_rss_mb:,.0f}MB{change('peak_rss_mb')}\n"
+        f"{'':>8} {stages}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark extract_info on synthetic records with cold and warm "
+        "caches"
+    )
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="seconds the Google API stand-in takes to answer (default: 0.05)",
+    )
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of results saved earlier")
+    args = parser.parse_args()
+    baselines: Dict[Tuple[int, str], Dict[str, Any]] = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            for result in json.load(baseline_file)["results"]:
+                baselines[result["rows"], result["cache"]] = result
+    results = []
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            cache_name = os.path.join(directory, "cache.json")
+            for warm in [False, True]:
+                result = run_in_process(rows, warm, cache_name, args.seed, args.latency)
+                print_result(result, baselines.get((rows, result.cache), {}))
+                results.append(result)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as save_file:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "seed": args.seed,
+                    "latency": args.latency,
+                    "results": list(map(asdict, results)),
+                },
+                save_file,
+                indent=1,
+            )
+
+
+if __name__ == "__main__":
+    main()
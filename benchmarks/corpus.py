@@ -0,0 +1,74 @@
+"""
+Reproducible synthetic records like the Trello export: a date, one or two
+people, Latin or Cyrillic, with an email, a phone number in one of several
+formats, or both, and some English or Russian notes. Some records have no
+contacts, so they're skipped.
+"""
+
+import random
+from typing import Iterator
+
+LATIN_FIRST_NAMES = ["Lisa", "David", "Maria", "John", "Anna", "Peter", "Sarah"]
+LATIN_LAST_NAMES = ["Smith", "McCall", "Miller", "Kochi", "Pierre", "Lee", "Brown"]
+CYRILLIC_FIRST_NAMES = ["Елена", "Иван", "Ольга", "Дмитрий", "Наталья", "Сергей"]
+CYRILLIC_LAST_NAMES = ["Иванова", "Петров", "Смирнова", "Кузнецов", "Попова"]
+# for their emails
+TRANSLITERATIONS = {
+    "Елена": "elena",
+    "Иван": "ivan",
+    "Ольга": "olga",
+    "Дмитрий": "dmitry",
+    "Наталья": "natalya",
+    "Сергей": "sergey",
+}
+NOTES = (
+    "balloon drop off paid check deposited Planet Fitness cr card arch 3 colors "
+    "шары доставка оплачено забрать в офисе арка перевод на карту"
+).split()
+# formats and area codes for 7 more digits. phonenumbers finds all but the
+# domestic Russian format, since lines are parsed as US numbers
+PHONE_FORMATS = [
+    ("{}.{}{}{}.{}{}{}{}", ["617", "603", "212"]),
+    ("({}) {}{}{}-{}{}{}{}", ["617", "415", "312"]),
+    ("{}-{}{}{}-{}{}{}{} x 1{}", ["603", "212"]),
+    ("+7 {} {}{}{}-{}{}-{}{}", ["495", "812", "912"]),
+    ("8 ({}) {}{}{}-{}{}-{}{}", ["495", "912"]),
+    ("+44 20 {}{}{}{} {}{}{}{}", ["3", "7", "8"]),
+]
+
+
+def generate_phone(rng: random.Random) -> str:
+    phone_format, area_codes = rng.choice(PHONE_FORMATS)
+    # exchanges don't start with 0 or 1
+    digits = [rng.randint(2, 9)] + [rng.randint(0, 9) for _ in range(7)]
+    area_code = rng.choice(area_codes)
+    return phone_format.format(area_code, *digits)
+
+
+def generate_person(rng: random.Random) -> str:
+    if rng.random() < 0.5:
+        first = rng.choice(LATIN_FIRST_NAMES)
+        name = f"{first} {rng.choice(LATIN_LAST_NAMES)}"
+        handle = first.lower()
+    else:
+        first = rng.choice(CYRILLIC_FIRST_NAMES)
+        name = f"{first} {rng.choice(CYRILLIC_LAST_NAMES)}"
+        handle = TRANSLITERATIONS[first]
+    contacts = []
+    kind = rng.random()
+    if kind < 0.6:
+        contacts.append(generate_phone(rng))
+    if kind > 0.4:
+        contacts.append(f"{handle}{rng.randint(1, 99)}@example.com")
+    return " ".join([name, *contacts])
+
+
+def generate_records(count: int, seed: int = 0) -> Iterator[str]:
+    "The same count records for the same seed"
+    rng = random.Random(seed)
+    for _ in range(count):
+        parts = [f"{rng.randint(1, 12)}/{rng.randint(1, 31)}"]
+        parts += rng.sample(NOTES, rng.randint(1, 6))
+        for _ in range(rng.choice([0, 1, 1, 1, 2])):
+            parts.insert(rng.randint(1, len(parts)), generate_person(rng))
+        yield " ".join(parts)
@@ -1,64 +1,934 @@
 from __future__ import division
+import io
+import os
+import re
+import sys
+import base64
 import json
+import mmap
+import types
+import struct
+import time
+import hashlib
+import inspect
+import tokenize
+import textwrap
 import functools
-from collections import defaultdict
-from typing import List, Dict, Callable, Any, Union
+import threading
+from array import array
+from collections import defaultdict, OrderedDict
+from dataclasses import dataclass
+from enum import Enum
+from typing import (
+    List,
+    Dict,
+    Set,
+    Tuple,
+    Callable,
+    Any,
+    Union,
+    Optional,
+    IO,
+    Iterable,
+    Iterator,
+)
+
+CacheEntries = Dict[str, Dict[str, Any]]
+Records = Iterable[Tuple[bytes, bytes]]
+
+
+class Eviction(str, Enum):
+    "Whether the size limit applies to all cached functions together or to each one"
+
+    lru = "lru"
+    per_function = "per_function"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    compute_time: float = 0.0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / ((self.hits + self.misses) or 1)
+
+    @property
+    def time_saved(self) -> float:
+        "Estimate of how long the hits would have taken to compute"
+        return self.hits * self.compute_time / (self.misses or 1)
+
+    def merge(self, other: "CacheStats") -> None:
+        self.hits += other.hits
+        self.misses += other.misses
+        self.compute_time += other.compute_time
+        self.evictions += other.evictions
+
+
+class Uncached:
+    """
+    Return Uncached(value) from a cached function to return value without storing
+    it, e.g. a default for an error that might not happen next time.
+    """
+
+    def __init__(self, value: Any):
+        self.value = value
+
+
+def unwrap(value: Any) -> Any:
+    return value.value if isinstance(value, Uncached) else value
+
 
 class Cache:
     """
     Non-functional persistent cache for storing expensive computation between runs.
 
-    Only stores the first argument and repeats it exactly once when saving
-    to disk, i.e. {text: {func1: result1, func2: result2}, text2: {...}, ...}
+    Only stores the first argument, i.e. {text: {func1: result1, func2: result2},
+    text2: {...}, ...}
+
+    Results live in an immutable Snapshot that is opened with mmap and only decoded
+    on lookup, plus an in-memory overlay of everything computed since. New results
+    are appended to a log next to the cache file as soon as they're computed, one
+    JSON record per line: [text, func, result] for a result or [func] for
+    clear_cache. Once the log gets long it's folded into a new snapshot by a
+    background thread, so neither starting nor exiting touches the whole cache.
+
+    A cache file from before snapshots (plain JSON at cache_name) is read once and
+    compacted into the first snapshot.
+
+    Each cached function's fingerprint (see fingerprint) is kept next to the cache
+    file. If a function has changed since its results were cached, they're
+    cleared the first time it's used, so that they're recomputed and the stale
+    ones are dropped at the next compaction. Other functions keep their results.
+
+    With hash_keys, texts are stored as short digests (see hash_key) rather than
+    verbatim. Texts cached without it are cached again with it. That only makes
+    the log and snapshot smaller, not the memory used: the overlay grows a
+    little, since the digests are new strings and verbatim keys are the lines
+    themselves.
+
+    If max_entries or max_bytes are set, compaction evicts the least recently used
+    results until the snapshot fits, either across all functions (Eviction.lru) or
+    within each function (Eviction.per_function). Hits, misses, compute time and
+    evictions are counted per function in stats.
     """
 
-    # maybe add cache hit/miss statistics in the future
-    def __init__(self, cache_name: str = "data/cache.json"):
+    def __init__(
+        self,
+        cache_name: str = "data/cache.json",
+        compact_after: int = 10000,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        eviction: Eviction = Eviction.lru,
+        hash_keys: bool = False,
+    ):
         # this needs to be called before cached funcs are defined
+        self.move(cache_name)
+        self.compact_after = compact_after
+        # the overlay, results from the logs that aren't in the snapshot yet
+        self.cache: Dict[str, Dict[str, Any]]
+        # the overlay that's being compacted into the next snapshot
+        self.compacting_cache: CacheEntries = {}
+        # the snapshot and the funcs that were cleared since it was written,
+        # swapped together when a compaction finishes
+        self.base: Tuple[Optional[Snapshot], Set[str]] = (None, set())
+        self.cleared_while_compacting: Set[str] = set()
+        # results computed since the last pop_new_entries, only tracked in
+        # worker processes that need to hand them back (see track_new_entries)
+        self.new_entries: Optional[CacheEntries] = None
+        self.loaded = False
+        self.log: Optional[IO] = None
+        self.log_length = 0
+        self.log_bytes = 0
+        self.lock = threading.Lock()
+        self.compaction: Optional[threading.Thread] = None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.hash_keys = hash_keys
+        # (text, func) -> record size of the results used this run, least recent
+        # first, for each group the size limit applies to. only tracked if bounded
+        self.recency: Dict[Optional[str], Dict[Tuple[str, str], int]] = defaultdict(
+            OrderedDict
+        )
+        self.recency_bytes: Dict[Optional[str], int] = defaultdict(int)
+        self.stats: Dict[str, CacheStats] = defaultdict(CacheStats)
+        # func name -> the fingerprint of the code its results were computed with
+        self.fingerprints: Dict[str, str] = {}
+        # func name -> the functions that compute its results
+        self.funcs: Dict[str, List[Callable]] = {}
+        # funcs whose fingerprints have been compared since loading
+        self.checked: Set[str] = set()
+        self.fingerprint_lock = threading.Lock()
+
+    def settings(self) -> Dict[str, Any]:
+        "Everything a cache in another process needs to be set up like this one"
+        return {
+            "cache_name": self.cache_name,
+            "compact_after": self.compact_after,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "eviction": self.eviction,
+            "hash_keys": self.hash_keys,
+        }
+
+    def configure(self, cache_name: Optional[str] = None, **settings: Any) -> None:
+        "Set up like the cache settings came from, before loading"
+        if cache_name is not None and cache_name != self.cache_name:
+            self.move(cache_name)
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+    def move(self, cache_name: str) -> None:
+        """
+        Use the files at cache_name from the next load on, e.g. a scratch cache for
+        benchmarks, without redefining the cached funcs
+        """
         self.cache_name = cache_name
-        self.cache: Dict[str, Dict[str, str]]
+        self.snapshot_name = cache_name + ".snapshot"
+        self.log_name = cache_name + ".log"
+        # the log being folded into the snapshot, if a compaction is running
+        # (or was interrupted, in which case the next one picks it up)
+        self.compacting_name = cache_name + ".compacting"
+        self.fingerprints_name = cache_name + ".fingerprints"
 
-    def __enter__(self) -> None:
-        # this only needs to be called before cached funcs are called
+    def load(self) -> None:
+        data: CacheEntries = {}
+        snapshot = None
+        if os.path.exists(self.snapshot_name):
+            snapshot = Snapshot(self.snapshot_name)
+        else:
+            data = self.read_cache_file()
+        cleared: Set[str] = set()
+        replay_log(self.compacting_name, data, cleared)
+        self.log_length = replay_log(self.log_name, data, cleared)
+        self.cache = defaultdict(dict, data)
+        self.compacting_cache = {}
+        self.base = (snapshot, cleared)
         try:
-            data = json.load(open(self.cache_name, encoding="utf-8"))
+            with open(self.fingerprints_name, encoding="utf-8") as f:
+                self.fingerprints = json.load(f)
         except IOError:
-            data = {}
-        self.cache = defaultdict(dict, data)
+            self.fingerprints = {}
+        self.checked = set()
+        self.loaded = True
+
+    def __enter__(self) -> None:
+        # this only needs to be called before cached funcs are called
+        self.load()
+        self.log = open_log(self.log_name)
+        for func_name in list(self.funcs):
+            self.check_fingerprint(func_name)
+        if os.path.exists(self.compacting_name) or (
+            not self.base[0] and os.path.exists(self.cache_name)
+        ):
+            self.start_compaction()
 
     def __exit__(self, *exception_info: Any) -> None:
-        with open(self.cache_name, "w", encoding="utf-8") as f:
-            json.dump(dict(self.cache), f)
+        if self.compaction:
+            self.compaction.join()
+        with self.lock:
+            if self.log:
+                self.log.close()
+            self.log = None
         print("saved cache")
 
+    def read_cache_file(self) -> CacheEntries:
+        try:
+            with open(self.cache_name, encoding="utf-8") as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def stored_key(self, key: str) -> str:
+        return hash_key(key) if self.hash_keys else key
+
+    def get(self, key: str, func_name: str) -> Any:
+        stored_key = self.stored_key(key)
+        for overlay in (self.cache, self.compacting_cache):
+            results = overlay.get(stored_key)
+            if results is not None and func_name in results:
+                self.touch(stored_key, func_name, results[func_name])
+                return results[func_name]
+        snapshot, cleared = self.base
+        if snapshot is None or func_name in cleared:
+            raise KeyError(key, func_name)
+        raw_value = snapshot.get_raw(make_entry_key(stored_key, func_name))
+        value = json.loads(raw_value)
+        self.touch(stored_key, func_name, value, len(raw_value))
+        return value
+
+    @property
+    def bounded(self) -> bool:
+        return self.max_entries is not None or self.max_bytes is not None
+
+    def over_budget(self, entries: int, size: int) -> bool:
+        return (self.max_entries is not None and entries > self.max_entries) or (
+            self.max_bytes is not None and size > self.max_bytes
+        )
+
+    def group(self, func_name: str) -> Optional[str]:
+        return func_name if self.eviction is Eviction.per_function else None
+
+    def touch(
+        self, key: str, func_name: str, value: Any, value_size: Optional[int] = None
+    ) -> None:
+        "Mark a result as the most recently used one"
+        if not self.bounded:
+            return
+        if value_size is None:
+            value_size = len(json.dumps(value)) if self.max_bytes is not None else 0
+        size = record_size(make_entry_key(key, func_name), value_size)
+        group = self.group(func_name)
+        with self.lock:
+            recency = self.recency[group]
+            self.recency_bytes[group] += size - recency.pop((key, func_name), 0)
+            recency[key, func_name] = size
+            # anything that doesn't fit is getting evicted anyway
+            while self.over_budget(len(recency), self.recency_bytes[group]):
+                self.recency_bytes[group] -= recency.popitem(last=False)[1]
+
+    def append_to_log(self, record: List[Any]) -> None:
+        with self.lock:
+            if not self.log:
+                # detached (worker) and loaded-but-not-entered caches don't persist
+                return
+            line = json.dumps(record) + "\n"
+            self.log.write(line)
+            # flushed to the OS, so killing the process doesn't lose anything
+            self.log.flush()
+            self.log_length += 1
+            self.log_bytes += len(line)
+        # the overlay holds what's in the log, so compacting also keeps it within
+        # a global limit (a per-function one is only enforced on the snapshot)
+        if self.log_length >= self.compact_after or (
+            self.eviction is Eviction.lru
+            and self.over_budget(self.log_length, self.log_bytes)
+        ):
+            self.start_compaction()
+
+    def start_compaction(self) -> None:
+        with self.lock:
+            if not self.log or (self.compaction and self.compaction.is_alive()):
+                return
+            # the current log becomes (or is added to) the log being compacted,
+            # new results go to a fresh log and overlay in the meantime
+            self.log.close()
+            if os.path.exists(self.compacting_name):
+                with open(self.compacting_name, "a", encoding="utf-8") as compacting:
+                    with open(self.log_name, encoding="utf-8") as log:
+                        compacting.write(log.read())
+                os.remove(self.log_name)
+            else:
+                os.replace(self.log_name, self.compacting_name)
+            self.log = open_log(self.log_name)
+            self.log_length = self.log_bytes = 0
+            self.compacting_cache, self.cache = self.cache, defaultdict(dict)
+            self.cleared_while_compacting = set()
+            touched = [entry for group in self.recency.values() for entry in group]
+        self.compaction = threading.Thread(
+            target=self.compact, args=(touched,), daemon=True
+        )
+        self.compaction.start()
+
+    def compact(self, touched: List[Tuple[str, str]]) -> None:
+        "Fold the compacting log into a new snapshot. Only reads from disk."
+        overrides: CacheEntries = {}
+        cleared: Set[str] = set()
+        replay_log(self.compacting_name, overrides, cleared)
+        evictions: Dict[str, int] = defaultdict(int)
+        write_snapshot(
+            self.snapshot_name,
+            self.compacted_records(overrides, cleared, touched, evictions),
+        )
+        snapshot = Snapshot(self.snapshot_name)
+        with self.lock:
+            self.base = (snapshot, self.cleared_while_compacting)
+            self.compacting_cache = {}
+            for func_name, evicted in evictions.items():
+                self.stats[func_name].evictions += evicted
+        os.remove(self.compacting_name)
+
+    def compacted_records(
+        self,
+        overrides: CacheEntries,
+        cleared: Set[str],
+        touched: List[Tuple[str, str]],
+        evictions: Dict[str, int],
+    ) -> Records:
+        """
+        Yield the records for the next snapshot, least recently used first, so the
+        snapshot's order is what the next compaction evicts by. If it's bounded,
+        skip the oldest records of each group until the rest of them fit.
+        """
+        snapshot = None
+        legacy: CacheEntries = {}
+        if os.path.exists(self.snapshot_name):
+            snapshot = Snapshot(self.snapshot_name)
+        else:
+            legacy = self.read_cache_file()
+        touched_keys = {make_entry_key(*entry) for entry in touched}
+
+        def by_age() -> Iterator[Tuple[str, bytes, bytes]]:
+            # results that weren't used this run, in the order they were last
+            # compacted in and then the order they were computed in
+            base = snapshot if snapshot else entries_to_records(legacy)
+            for entry_key, value in base:
+                text, _, func_name = entry_key.decode("utf-8").rpartition("\0")
+                if func_name in cleared or func_name in overrides.get(text, {}):
+                    continue
+                if entry_key not in touched_keys:
+                    yield func_name, entry_key, value
+            for text, results in overrides.items():
+                for func_name, result in results.items():
+                    entry_key = make_entry_key(text, func_name)
+                    if entry_key not in touched_keys:
+                        yield func_name, entry_key, json.dumps(result).encode("utf-8")
+            # then the ones that were, least recent first
+            for text, func_name in touched:
+                entry_key = make_entry_key(text, func_name)
+                if func_name in overrides.get(text, {}):
+                    result = overrides[text][func_name]
+                elif func_name in cleared:
+                    continue
+                elif snapshot:
+                    try:
+                        yield func_name, entry_key, snapshot.get_raw(entry_key)
+                    except KeyError:
+                        pass
+                    continue
+                elif func_name in legacy.get(text, {}):
+                    result = legacy[text][func_name]
+                else:
+                    continue
+                yield func_name, entry_key, json.dumps(result).encode("utf-8")
+
+        if not self.bounded:
+            for _, entry_key, value in by_age():
+                yield entry_key, value
+            return
+        # [entries, bytes] in each group
+        totals: Dict[Optional[str], List[int]] = defaultdict(lambda: [0, 0])
+        for func_name, entry_key, value in by_age():
+            total = totals[self.group(func_name)]
+            total[0] += 1
+            total[1] += record_size(entry_key, len(value))
+        for func_name, entry_key, value in by_age():
+            total = totals[self.group(func_name)]
+            if self.over_budget(*total):
+                total[0] -= 1
+                total[1] -= record_size(entry_key, len(value))
+                evictions[func_name] += 1
+                continue
+            yield entry_key, value
+
     def clear_cache(self, func_name: str) -> None:
-        for item in self.cache.values():
-            if func_name in item:
-                del item[func_name]
+        with self.lock:
+            for overlay in (self.cache, self.compacting_cache):
+                for item in overlay.values():
+                    item.pop(func_name, None)
+            self.base[1].add(func_name)
+            self.cleared_while_compacting.add(func_name)
+        self.append_to_log([func_name])
+
+    def check_fingerprint(self, func_name: str) -> None:
+        "Clear func_name's results if its code has changed since they were cached"
+        if func_name in self.checked:
+            return
+        with self.fingerprint_lock:
+            if func_name in self.checked:
+                return
+            current = fingerprint(*self.funcs[func_name])
+            recorded = self.fingerprints.get(func_name)
+            if recorded != current:
+                # results from before fingerprints are assumed to be current
+                if recorded is not None:
+                    self.clear_cache(func_name)
+                self.fingerprints[func_name] = current
+                # only the process that writes the log records them
+                if self.log:
+                    self.save_fingerprints()
+            self.checked.add(func_name)
+
+    def save_fingerprints(self) -> None:
+        with open(self.fingerprints_name + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.fingerprints, f, indent=1, sort_keys=True)
+        os.replace(self.fingerprints_name + ".tmp", self.fingerprints_name)
+
+    def detach(self) -> None:
+        """
+        Stop writing to the log and compacting, e.g. in a forked worker, which
+        inherits the parent's open log, for the parent to write its results once
+        they're merged. Everything written is already flushed, so closing the
+        worker's copy loses nothing.
+        """
+        with self.lock:
+            if self.log:
+                self.log.close()
+            self.log = None
+            self.log_length = 0
+            self.log_bytes = 0
+            self.compaction = None
+
+    def track_new_entries(self) -> None:
+        self.new_entries = defaultdict(dict)
+
+    def pop_new_entries(self) -> CacheEntries:
+        new_entries = dict(self.new_entries or {})
+        if self.new_entries is not None:
+            self.new_entries = defaultdict(dict)
+        return new_entries
+
+    def pop_stats(self) -> Dict[str, CacheStats]:
+        stats, self.stats = self.stats, defaultdict(CacheStats)
+        return dict(stats)
+
+    def merge_stats(self, stats: Dict[str, CacheStats]) -> None:
+        for func_name, func_stats in stats.items():
+            self.stats[func_name].merge(func_stats)
+
+    def print_stats(self) -> None:
+        row = "{:<40} {:>8} {:>8} {:>9} {:>11} {:>9} {:>8}"
+        print(
+            row.format(
+                "cached function",
+                "hits",
+                "misses",
+                "hit rate",
+                "compute s",
+                "saved s",
+                "evicted",
+            )
+        )
+        for func_name, stats in sorted(self.stats.items()):
+            print(
+                row.format(
+                    func_name,
+                    stats.hits,
+                    stats.misses,
+                    "{:.1%}".format(stats.hit_rate),
+                    "{:.2f}".format(stats.compute_time),
+                    "{:.2f}".format(stats.time_saved),
+                    stats.evictions,
+                )
+            )
+
+    def merge(self, entries: CacheEntries) -> None:
+        "Add results computed elsewhere, e.g. by another process's copy of the cache"
+        for key, results in entries.items():
+            self.cache[key].update(results)
+            for func_name, value in results.items():
+                self.append_to_log([key, func_name, value])
+
+    def store(self, key: str, func_name: str, value: Any) -> None:
+        stored_key = self.stored_key(key)
+        self.cache[stored_key][func_name] = value
+        self.touch(stored_key, func_name, value)
+        self.append_to_log([stored_key, func_name, value])
+        if self.new_entries is not None:
+            self.new_entries[stored_key][func_name] = value
 
     def with_cache(self, func: Callable) -> Callable:
         func_name = func.__name__
+        self.funcs[func_name] = [func]
+        self.checked.discard(func_name)
 
         @functools.wraps(func)
         def wrapper(arg1: Union[str, List[str]], *args: Any, **kwargs: Any) -> Any:
-            if isinstance(arg1, list):
-                key = json.dumps(arg1)
-            else:
-                key = arg1
+            self.check_fingerprint(func_name)
+            key = make_key(arg1)
+            stats = self.stats[func_name]
             try:
-                return self.cache[key][func_name]
+                value = self.get(key, func_name)
             except KeyError:
                 pass
+            else:
+                stats.hits += 1
+                return value
+            start = time.perf_counter()
             value = func(arg1, *args, **kwargs)
-            # nice-to-have: allow a default value to be returned in case
-            # of errors, and don't store that (instead of current impl
-            # where the function has to catch its error and that defaut is
-            # cached)
-            self.cache[key][func_name] = value
+            stats.misses += 1
+            stats.compute_time += time.perf_counter() - start
+            if isinstance(value, Uncached):
+                return value.value
+            self.store(key, func_name, value)
             return value
 
         return wrapper
 
+    def batch_of(self, cached_func: Callable) -> Callable[[Callable], Callable]:
+        """
+        Decorator for a function that computes a with_cache function for a list of
+        arguments at once. The result takes a list of arguments, passes on only the
+        ones that miss the cache, and caches what comes back as cached_func's
+        results, except the ones wrapped in Uncached. It's also attached to
+        cached_func as cached_func.batch, and changing it invalidates cached_func's
+        results too.
+        """
+        func_name = cached_func.__name__
 
-cache = Cache()
+        def decorator(batch_func: Callable[[List[Any]], List[Any]]) -> Callable:
+            self.funcs[func_name].append(batch_func)
+            self.checked.discard(func_name)
+
+            @functools.wraps(batch_func)
+            def wrapper(args: List[Any]) -> List[Any]:
+                self.check_fingerprint(func_name)
+                stats = self.stats[func_name]
+                values: Dict[str, Any] = {}
+                missing: Dict[str, Any] = {}
+                for arg in args:
+                    key = make_key(arg)
+                    if key in values or key in missing:
+                        continue
+                    try:
+                        values[key] = self.get(key, func_name)
+                    except KeyError:
+                        missing[key] = arg
+                stats.hits += len(values)
+                if missing:
+                    start = time.perf_counter()
+                    computed = batch_func(list(missing.values()))
+                    stats.misses += len(missing)
+                    stats.compute_time += time.perf_counter() - start
+                    for key, value in zip(missing, computed):
+                        if not isinstance(value, Uncached):
+                            self.store(key, func_name, value)
+                        values[key] = value
+                return [unwrap(values[make_key(arg)]) for arg in args]
+
+            cached_func.batch = wrapper  # type: ignore
+            return wrapper
+
+        return decorator
+
+
+def make_key(arg: Union[str, List[str]]) -> str:
+    if isinstance(arg, list):
+        return json.dumps(arg)
+    return arg
+
+
+def source_tokens(func: types.FunctionType) -> bytes:
+    "func's source without comments, blank lines or indentation"
+    try:
+        source = textwrap.dedent(inspect.getsource(func))
+    except (OSError, TypeError):
+        return func.__code__.co_code
+    try:
+        return " ".join(
+            "\t" if token.type == tokenize.INDENT else token.string
+            for token in tokenize.generate_tokens(io.StringIO(source).readline)
+            if token.type not in (tokenize.COMMENT, tokenize.NL)
+        ).encode("utf-8")
+    except (tokenize.TokenError, SyntaxError):
+        # e.g. a lambda in the middle of an expression
+        return source.encode("utf-8")
+
+
+def code_names(code: types.CodeType) -> Iterator[str]:
+    "The global names code (or the functions and comprehensions in it) uses"
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from code_names(const)
+
+
+SIMPLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+def constant_repr(value: Any, mutable: bool = False) -> Optional[str]:
+    """
+    repr of value if it's made of simple values, compiled regexes and tuples or
+    frozensets of them, the same from one run to the next (so sets are sorted),
+    else None. With mutable, lists, dicts and sets count too, for constants that
+    just happen to be them, e.g. a str.maketrans table.
+    """
+    if isinstance(value, SIMPLE_TYPES):
+        return repr(value)
+    if isinstance(value, re.Pattern):
+        return f"re.compile({value.pattern!r}, {value.flags})"
+    if isinstance(value, (list, dict, set)) and not mutable:
+        return None
+    if isinstance(value, dict):
+        items = [
+            (constant_repr(key), constant_repr(item, mutable))
+            for key, item in value.items()
+        ]
+        if any(key is None or item is None for key, item in items):
+            return None
+        return "{" + ", ".join(f"{key}: {item}" for key, item in items) + "}"
+    if isinstance(value, (tuple, list, set, frozenset)):
+        reprs = [constant_repr(item, mutable) for item in value]
+        if None in reprs:
+            return None
+        if isinstance(value, (set, frozenset)):
+            reprs.sort()
+        return f"{type(value).__name__}({', '.join(reprs)})"  # type: ignore
+    return None
+
+
+def fingerprint(*funcs: Callable) -> str:
+    """
+    Hash of the source of funcs, ignoring comments and formatting, and of the
+    functions they use: the ones in their closures (e.g. the parts composed by
+    strategies.compose) or partials, and the ones they refer to by name that are
+    in their own module, including through decorators like lru_cache. The
+    constants they refer to by name count too (see constant_repr), where only
+    UPPER_CASE names can be lists, dicts or sets. Other modules'
+    functions (e.g. NLTK's) aren't followed, and builtins only count by name.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    seen: Set[int] = set()
+
+    def visit(value: Any) -> None:
+        constant = constant_repr(value)
+        if constant is not None:
+            digest.update(constant.encode("utf-8"))
+            return
+        if isinstance(value, tuple):
+            for item in value:
+                visit(item)
+            return
+        if not callable(value):
+            return
+        func = inspect.unwrap(value)
+        if id(func) in seen:
+            return
+        seen.add(id(func))
+        if isinstance(func, functools.partial):
+            visit(func.func)
+            for arg in func.args:
+                visit(arg)
+            for keyword, arg in sorted(func.keywords.items()):
+                digest.update(keyword.encode("utf-8"))
+                visit(arg)
+        elif isinstance(func, types.FunctionType):
+            digest.update(source_tokens(func))
+            for cell in func.__closure__ or ():
+                try:
+                    visit(cell.cell_contents)
+                except ValueError:
+                    pass  # not assigned yet
+            for name in code_names(func.__code__):
+                if name not in func.__globals__:
+                    continue  # a builtin, or an attribute
+                used = func.__globals__[name]
+                constant = constant_repr(used, mutable=name.isupper())
+                if constant is not None:
+                    digest.update(f"{name} = {constant}".encode("utf-8"))
+                    continue
+                if callable(used):
+                    used = inspect.unwrap(used)
+                if (
+                    isinstance(used, types.FunctionType)
+                    and used.__module__ == func.__module__
+                ):
+                    visit(used)
+        else:
+            digest.update(getattr(func, "__qualname__", type(func).__name__).encode())
+
+    for func in funcs:
+        visit(func)
+    return digest.hexdigest()
+
+
+def hash_key(key: str) -> str:
+    """
+    96 bit digest of a text, 17 characters long. Two texts only get each other's
+    results if their digests collide, which takes around 2**48 texts to be likely.
+    (Also storing a checksum of the text to check against would only amount to a
+    wider digest.)
+    """
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=12).digest()
+    return "#" + base64.urlsafe_b64encode(digest).decode("ascii")
+
+
+SNAPSHOT_MAGIC = b"EXTINFO2"
+# EXTINFO1 is the same without shared values, so it can still be read
+SNAPSHOT_MAGICS = {b"EXTINFO1", SNAPSHOT_MAGIC}
+
+
+def make_entry_key(key: str, func_name: str) -> bytes:
+    return key.encode("utf-8") + b"\0" + func_name.encode("utf-8")
 
+
+def hash_entry_key(entry_key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(entry_key, digest_size=8).digest(), "little")
+
+
+class Snapshot:
+    """
+    Immutable map from (text, func) to result, opened with mmap and only decoded
+    on lookup, so opening one is instant and processes share its pages.
+
+    Layout: magic, slot count and index offset, then the records, each the length
+    of its key and value, the key (text, NUL, func) and the JSON result, then the
+    index, an open addressing hash table of (hash, record offset) slots.
+
+    Results that are the same as an earlier record's (e.g. the same names found
+    by several functions) are only stored once: the record's value length has the
+    SHARED bit set and it holds the offset of the earlier result instead.
+    """
+
+    HEADER = struct.Struct("<8sQQ")
+    RECORD = struct.Struct("<II")
+    SLOT = struct.Struct("<QQ")
+    SHARED = 1 << 31
+    SHARED_VALUE = struct.Struct("<Q")
+
+    def __init__(self, snapshot_name: str):
+        with open(snapshot_name, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, self.index_offset = self.HEADER.unpack_from(self.data)
+        if magic not in SNAPSHOT_MAGICS:
+            raise ValueError(f"{snapshot_name} isn't a cache snapshot")
+
+    def read_record(self, offset: int) -> Tuple[bytes, bytes, int]:
+        key_length, value_length = self.RECORD.unpack_from(self.data, offset)
+        key_start = offset + self.RECORD.size
+        value_start = key_start + key_length
+        if value_length & self.SHARED:
+            (shared_start,) = self.SHARED_VALUE.unpack_from(self.data, value_start)
+            shared_end = shared_start + (value_length & ~self.SHARED)
+            return (
+                self.data[key_start:value_start],
+                self.data[shared_start:shared_end],
+                value_start + self.SHARED_VALUE.size,
+            )
+        value_end = value_start + value_length
+        return (
+            self.data[key_start:value_start],
+            self.data[value_start:value_end],
+            value_end,
+        )
+
+    def get(self, key: str, func_name: str) -> Any:
+        return json.loads(self.get_raw(make_entry_key(key, func_name)))
+
+    def get_raw(self, entry_key: bytes) -> bytes:
+        hashed = hash_entry_key(entry_key)
+        slot = hashed % self.slots
+        while True:
+            slot_hash, offset = self.SLOT.unpack_from(
+                self.data, self.index_offset + slot * self.SLOT.size
+            )
+            if not offset:
+                raise KeyError(entry_key)
+            if slot_hash == hashed:
+                stored_key, value, _ = self.read_record(offset)
+                if stored_key == entry_key:
+                    return value
+            slot = (slot + 1) % self.slots
+
+    def __iter__(self) -> Iterator[Tuple[bytes, bytes]]:
+        offset = self.HEADER.size
+        while offset < self.index_offset:
+            entry_key, value, offset = self.read_record(offset)
+            yield entry_key, value
+
+
+def write_snapshot(snapshot_name: str, records: Records) -> None:
+    "Write (entry key, JSON result) records, which have to be unique, as a Snapshot."
+    hashes, offsets = array("Q"), array("Q")
+    # digest of a result -> offset of its first copy
+    shared: Dict[bytes, int] = {}
+    # write to a temporary file first so a crash never leaves a partial snapshot
+    with open(snapshot_name + ".tmp", "wb") as f:
+        f.write(bytes(Snapshot.HEADER.size))
+        for entry_key, value in records:
+            hashes.append(hash_entry_key(entry_key))
+            offsets.append(f.tell())
+            # sharing shorter results would take more space than it saves
+            if len(value) > Snapshot.SHARED_VALUE.size:
+                digest = hashlib.blake2b(value, digest_size=16).digest()
+                shared_start = shared.get(digest)
+                if shared_start is not None:
+                    f.write(
+                        Snapshot.RECORD.pack(
+                            len(entry_key), Snapshot.SHARED | len(value)
+                        )
+                    )
+                    f.write(entry_key)
+                    f.write(Snapshot.SHARED_VALUE.pack(shared_start))
+                    continue
+                shared[digest] = f.tell() + Snapshot.RECORD.size + len(entry_key)
+            f.write(Snapshot.RECORD.pack(len(entry_key), len(value)))
+            f.write(entry_key)
+            f.write(value)
+        index_offset = f.tell()
+        # at most half full keeps probing short
+        slots = max(1, 2 * len(offsets))
+        index = array("Q", bytes(Snapshot.SLOT.size * slots))
+        for hashed, offset in zip(hashes, offsets):
+            slot = hashed % slots
+            while index[2 * slot + 1]:
+                slot = (slot + 1) % slots
+            index[2 * slot] = hashed
+            index[2 * slot + 1] = offset
+        if sys.byteorder == "big":
+            index.byteswap()
+        f.write(index.tobytes())
+        f.seek(0)
+        f.write(Snapshot.HEADER.pack(SNAPSHOT_MAGIC, slots, index_offset))
+    os.replace(snapshot_name + ".tmp", snapshot_name)
+
+
+def record_size(entry_key: bytes, value_size: int) -> int:
+    return Snapshot.RECORD.size + len(entry_key) + value_size
+
+
+def entries_to_records(entries: CacheEntries) -> Records:
+    for key, results in entries.items():
+        for func_name, value in results.items():
+            yield make_entry_key(key, func_name), json.dumps(value).encode("utf-8")
+
+
+def open_log(log_name: str) -> IO:
+    # make sure a torn last record from a crash doesn't swallow the next one
+    torn = False
+    if os.path.exists(log_name):
+        with open(log_name, "rb") as log:
+            if log.seek(0, os.SEEK_END):
+                log.seek(-1, os.SEEK_END)
+                torn = log.read(1) != b"\n"
+    log = open(log_name, "a", encoding="utf-8")
+    if torn:
+        log.write("\n")
+    return log
+
+
+def replay_log(log_name: str, data: CacheEntries, cleared: Set[str]) -> int:
+    """
+    Apply a cache log's records to data, adding cleared funcs to cleared, and
+    return how many records there were.
+    """
+    try:
+        log = open(log_name, encoding="utf-8")
+    except IOError:
+        return 0
+    length = 0
+    with log:
+        for line in log:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # torn write from a crash
+            if len(record) == 1:
+                (func_name,) = record
+                for item in data.values():
+                    item.pop(func_name, None)
+                cleared.add(func_name)
+            else:
+                key, func_name, value = record
+                data.setdefault(key, {})[func_name] = value
+            length += 1
+    return length
+
+
+cache = Cache()
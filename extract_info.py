@@ -1,24 +1,130 @@
 from __future__ import division
-import sys
+import os
+import io
 import csv
 import re
+import json
+import asyncio
+import argparse
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, Future
+from functools import partial
+from bisect import bisect_right
 from enum import Enum
-from itertools import zip_longest
-from typing import List, Mapping, Tuple, Sequence, Iterator, IO, Any
+from dataclasses import asdict
+from itertools import chain, zip_longest, islice
+from typing import (
+    AsyncIterator,
+    List,
+    Dict,
+    Deque,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Sequence,
+    Iterator,
+    Iterable,
+    IO,
+    Any,
+    Callable,
+    Generic,
+    TypeVar,
+    NamedTuple,
+)
 from phonenumbers import PhoneNumberMatcher, format_number, PhoneNumberFormat
-from strategies import Stages, STAGES
-from cache import cache
+from strategies import Stages, STAGES, STAGE_NAMES
+from cache import cache, CacheEntries, CacheStats, Eviction, fingerprint, hash_key
+from nltk_models import models, ModelsMissing
+from strategy_stats import strategy_stats, Records
+from instrumentation import instruments, Timings
 
 Names = List[str]
-NameAttempts = Iterator[Names]
-Entry = Mapping[str, Names]
+X = TypeVar("X")
+Y = TypeVar("Y")
+# an Entry, or a dict like it
+E = TypeVar("E", bound=Mapping[str, Names])
+
+
+class Entry(Mapping[str, Names]):
+    """
+    A line's contacts and names. Slots instead of a dict, and the line itself
+    instead of a list of it, but it works like the dict of lists entries used to
+    be, e.g. entry["line"] is [line], so code that took those takes these.
+    """
+
+    FIELDS = ("line", "emails", "phones", "names")
+    __slots__ = FIELDS
+
+    def __init__(self, line: str, emails: Names, phones: Names, names: Names):
+        self.line = line
+        self.emails = emails
+        self.phones = phones
+        self.names = names
+
+    @classmethod
+    def of(cls, entry: Mapping[str, Names]) -> "Entry":
+        "An Entry from a dict of lists, or the entry itself if it is one"
+        if isinstance(entry, Entry):
+            return entry
+        return cls(entry["line"][0], entry["emails"], entry["phones"], entry["names"])
+
+    def __getitem__(self, key: str) -> Names:
+        if key == "line":
+            return [self.line]
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.FIELDS)
+
+    def __len__(self) -> int:
+        return len(self.FIELDS)
+
+    def __repr__(self) -> str:
+        return "Entry({!r}, {!r}, {!r}, {!r})".format(
+            self.line, self.emails, self.phones, self.names
+        )
+
+    def __reduce__(self) -> Tuple[type, Tuple]:
+        return (Entry, (self.line, self.emails, self.phones, self.names))
+
+    def rows(self) -> Iterator[Tuple[str, ...]]:
+        "The CSV rows: the line, then one contact or name per column per row"
+        return zip_longest(
+            (self.line,), self.emails, self.phones, self.names, fillvalue=""
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "line": self.line,
+            "emails": self.emails,
+            "phones": self.phones,
+            "names": self.names,
+        }
+
+    @classmethod
+    def from_json(cls, entry: Mapping[str, Any]) -> "Entry":
+        return cls(entry["line"], entry["emails"], entry["phones"], entry["names"])
 
 
 EMAIL_RE = re.compile(r"[\w\.-]+@[\w\.-]+")
+# the fewest digits a valid phone number has, counting the country code, e.g.
+# +43 1234 (see test_min_phone_digits)
+MIN_PHONE_DIGITS = 6
+# PhoneNumberMatcher's candidates are digits with at most 4 characters between
+# them, and a few x's can be read as 9s, so a line needs this to have a number
+PHONE_CANDIDATE_RE = re.compile(
+    r"[\dxX](?:[^\dxX]{0,4}[\dxX]){%d,}" % (MIN_PHONE_DIGITS - 1)
+)
 
 
 def extract_contacts(line: str) -> Tuple[List[str], List[str]]:
     emails = EMAIL_RE.findall(line)
+    # PhoneNumberMatcher takes a while even when there's nothing to find
+    if not PHONE_CANDIDATE_RE.search(line):
+        return emails, []
     # "how hard can it be to write a regex to match phone numbers?"
     # way too hard for international formats, as it turns out
     phones = [
@@ -41,7 +147,60 @@ def min_max_names(emails: List[str], phones: List[str]) -> Tuple[int, int]:
     return (min_names, max_names)
 
 
-def fuzzy_intersect(left: Names, right: Names, recursive: bool = False) -> Names:
+# with at least this many names, fuzzy_intersect indexes them instead of checking
+# every pair, which is faster for smaller lists
+FUZZY_INDEX_MIN_NAMES = 300
+
+
+class NameIndex:
+    """
+    Names joined into one string, so that finding every name that contains a name
+    is a str.find per match instead of a substring check per name.
+    """
+
+    def __init__(self, names: Names):
+        self.starts: List[int] = []
+        start = 0
+        for name in names:
+            self.starts.append(start)
+            start += len(name) + 1
+        self.text = "\0".join(names)
+
+    def containing(self, name: str) -> Iterator[int]:
+        "Indexes of the names name is in"
+        position = self.text.find(name)
+        while position != -1:
+            i = bisect_right(self.starts, position) - 1
+            yield i
+            if i + 1 == len(self.starts):
+                return
+            position = self.text.find(name, self.starts[i + 1])
+
+
+def similarity(names: Names, others: Names) -> List[Set[int]]:
+    "For each name, the indexes of the others it contains or is contained by"
+    names_index, others_index = NameIndex(names), NameIndex(others)
+    similar = [set(others_index.containing(name)) for name in names]
+    for j, other in enumerate(others):
+        for i in names_index.containing(other):
+            similar[i].add(j)
+    return similar
+
+
+def remaining_similar(
+    name: str, names: Names, remaining: List[bool], similar: Optional[Set[int]]
+) -> List[int]:
+    "Indexes of the remaining names similar to name, in order"
+    if similar is None:
+        return [
+            i
+            for i, other in enumerate(names)
+            if remaining[i] and (other in name or name in other)
+        ]
+    return sorted(i for i in similar if remaining[i])
+
+
+def fuzzy_intersect(left: Names, right: Names) -> Names:
     """
     Take the first name on the left, if it contains or is contained by a name
     on the right, set aside all of the names on the left or right that the first
@@ -50,67 +209,123 @@ def fuzzy_intersect(left: Names, right: Names, recursive: bool = False) -> Names
 
     If either left or right are empty, return the other one.
     """
-    if recursive:
-        if not left:
-            return []
-    else:
-        if not (left and right):
-            return left or right
-    first_left, *remaining_left = left
-    similar_right = set(
-        right_name
-        for right_name in right
-        if right_name in first_left or first_left in right_name
-    )
-    if similar_right:
+    if not (left and right):
+        return left or right
+    # repeated names are set aside along with their first occurence anyway
+    left, right = list(dict.fromkeys(left)), list(dict.fromkeys(right))
+    similar_right: List[Optional[Set[int]]] = [None] * len(left)
+    similar_left: List[Optional[Set[int]]] = [None] * len(left)
+    if len(left) + len(right) >= FUZZY_INDEX_MIN_NAMES:
+        similar_right = similarity(left, right)  # type: ignore
+        similar_left = similarity(left, left)  # type: ignore
+    remaining_left = [True] * len(left)
+    remaining_right = [True] * len(right)
+    intersection = []
+    for i, first_left in enumerate(left):
+        if not remaining_left[i]:
+            continue
+        remaining_left[i] = False
+        set_aside_right = remaining_similar(
+            first_left, right, remaining_right, similar_right[i]
+        )
+        if not set_aside_right:
+            continue
         # catch duplicate similar names
-        also_similar_left = set(
-            left_name
-            for left_name in remaining_left
-            if left_name in first_left or first_left in left_name
+        set_aside_left = remaining_similar(
+            first_left, left, remaining_left, similar_left[i]
+        )
+        intersection.append(
+            max(
+                first_left,
+                *(right[j] for j in set_aside_right),
+                *(left[j] for j in set_aside_left),
+                key=len,
+            )
         )
-        intersection = max(first_left, *similar_right, *also_similar_left, key=len)
-        dissimilar_right = list(set(right) - similar_right)
-        dissimilar_left = list(set(remaining_left) - also_similar_left)
-        return [intersection] + fuzzy_intersect(dissimilar_left, dissimilar_right, True)
-    return fuzzy_intersect(remaining_left, right, recursive=True)
+        for j in set_aside_right:
+            remaining_right[j] = False
+        for j in set_aside_left:
+            remaining_left[j] = False
+    return intersection
+
+
+class LazyList(Generic[X]):
+    "Can be iterated over any number of times, taking each item from items once"
+
+    def __init__(self, items: Iterable[X]):
+        self.items = iter(items)
+        self.taken: List[X] = []
+
+    def __iter__(self) -> Iterator[X]:
+        i = 0
+        while True:
+            if i == len(self.taken):
+                try:
+                    self.taken.append(next(self.items))
+                except StopIteration:
+                    return
+            yield self.taken[i]
+            i += 1
+
+
+def unique(attempts: Iterable[Tuple[X, Names]]) -> Iterator[Tuple[X, Names]]:
+    "Skip repeated names, whatever they came from"
+    seen: Set[Tuple[str, ...]] = set()
+    for source, attempt in attempts:
+        if tuple(attempt) not in seen:
+            seen.add(tuple(attempt))
+            yield source, attempt
+
+
+# names, with the strategy that found them
+Attempt = Tuple[Optional[Callable], Names]
 
 
 def extract_names(
     text: str, min_names: int, max_names: int, stages: Stages = STAGES
 ) -> Names:
-    def filter_min_criteria(attempts: NameAttempts) -> NameAttempts:
+    def filter_min_criteria(attempts: Iterable[Attempt]) -> Iterator[Attempt]:
         yielded_anything = False
-        for attempt in attempts:
+        for strategy, attempt in attempts:
             if len(attempt) >= min_names:
                 yielded_anything = True
-                yield attempt
+                yield strategy, attempt
         if not yielded_anything:
-            yield []
+            yield None, []
 
-    google_extractors, crude_extractors, refiners = stages
-    google_extractions: Iterator[Names] = filter_min_criteria(
-        extractor(text) for extractor in google_extractors
-    )
-    crude_extractions: Iterator[Names] = filter_min_criteria(
-        extractor(text) for extractor in crude_extractors
-    )
-    consensuses = (
-        fuzzy_intersect(google_extraction, crude_extraction)
-        for google_extraction in google_extractions
-        for crude_extraction in crude_extractions
+    def extractions(extractors: Sequence[Callable]) -> LazyList[Attempt]:
+        # each extractor runs at most once, when its result is first needed
+        return LazyList(
+            filter_min_criteria(
+                (extractor, strategy_stats.call(extractor, text))
+                for extractor in extractors
+            )
+        )
+
+    google_extractors, crude_extractors, refiners = map(strategy_stats.order, stages)
+    google_extractions = extractions(google_extractors)
+    crude_extractions = extractions(crude_extractors)
+    # every refinement of a repeated consensus has already been rejected
+    consensuses = unique(
+        ((google, crude), fuzzy_intersect(google_extraction, crude_extraction))
+        for google, google_extraction in google_extractions
+        for crude, crude_extraction in crude_extractions
     )
     refinements = (
-        refine(consensus) for consensus in consensuses for refine in refiners
+        ((*extractors, refine), strategy_stats.call(refine, consensus))
+        for extractors, consensus in consensuses
+        for refine in refiners
     )
     try:
-        return next(
-            refinement
-            for refinement in refinements
+        strategies, names = next(
+            (strategies, refinement)
+            for strategies, refinement in refinements
             if min_names <= len(refinement) <= max_names
         )
     except StopIteration:
         return []
+    strategy_stats.accept(*filter(None, strategies))
+    return names
 
 
 def space_dashes(text: str) -> str:
@@ -118,27 +333,320 @@ def space_dashes(text: str) -> str:
     return re.sub(r"-([^ -])", r"- \1", re.sub(r"([^ -])-", r"\1 -", text))
 
 
-def extract_info(raw_line: str, **extract_names_kwargs: Any) -> Mapping[str, List[str]]:
+class ParsedLine(NamedTuple):
+    line: str
+    emails: List[str]
+    phones: List[str]
+    min_names: int
+    max_names: int
+
+    @property
+    def clean_line(self) -> str:
+        "What names are extracted from"
+        return space_dashes(self.line)
+
+
+def parse_line(raw_line: str) -> ParsedLine:
     line = raw_line.replace("'", "").replace("\n", "")
     emails, phones = extract_contacts(line)
-    min_names, max_names = min_max_names(emails, phones)
+    return ParsedLine(line, emails, phones, *min_max_names(emails, phones))
+
+
+def extract_parsed_info(parsed: ParsedLine, **extract_names_kwargs: Any) -> Entry:
+    line, emails, phones, min_names, max_names = parsed
     if max_names == 0:
         names = ["skipped"]
     else:
-        clean_line = space_dashes(line)
-        names = extract_names(clean_line, min_names, max_names, **extract_names_kwargs)
-        print(".", end="")
-        sys.stdout.flush()
-    return {"line": [line], "emails": emails, "phones": phones, "names": names}
+        with instruments.line():
+            names = extract_names(
+                parsed.clean_line, min_names, max_names, **extract_names_kwargs
+            )
+    return Entry(line, emails, phones, names)
 
 
-def save_entries(entries: Sequence[Entry], out_file: IO) -> None:
-    writer = csv.writer(out_file)
-    writer.writerow(entries[0].keys())
-    for entry in entries:
-        contacts = zip_longest(*entry.values(), fillvalue="")
-        for contact in contacts:
-            writer.writerow(list(contact))
+def extract_info(raw_line: str, **extract_names_kwargs: Any) -> Entry:
+    return extract_parsed_info(parse_line(raw_line), **extract_names_kwargs)
+
+
+def init_worker(
+    offline_models: bool = False,
+    strategy_records: Optional[Records] = None,
+    cache_settings: Optional[Dict[str, Any]] = None,
+) -> None:
+    # forked workers inherit the parent's loaded cache, models and strategy
+    # records, spawned ones have to load them (the models once a line needs them)
+    # with the parent's settings
+    if cache_settings is not None:
+        cache.configure(**cache_settings)
+    if not cache.loaded:
+        cache.load()
+    # the parent logs the results it merges, forked workers would log them twice
+    cache.detach()
+    cache.track_new_entries()
+    models.offline = offline_models
+    if strategy_records is not None:
+        strategy_stats.adaptive = True
+        strategy_stats.records.clear()
+        strategy_stats.merge(strategy_records)
+    strategy_stats.pop_new_records()
+    instruments.pop_timings()
+
+
+def imap_bounded(
+    executor: Executor, func: Callable[[X], Y], items: Iterable[X], window: int
+) -> Iterator[Y]:
+    "Like executor.map, but only reads window items ahead, so items can be streamed."
+    pending: Deque[Future] = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def extract_info_threaded(
+    lines: Iterable[X], threads: int, extract: Callable[[X], Entry] = extract_info
+) -> Iterator[Entry]:
+    """
+    Extract lines in a thread pool, so each thread's Google requests are in flight
+    at the same time instead of one after the other. Entries stay in order.
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        yield from imap_bounded(executor, extract, lines, threads * 2)
+
+
+def prefetch(texts: List[str], stages: Stages = STAGES) -> None:
+    "Fill the cache for the extractors that can do many texts at once"
+    google_extractors, crude_extractors, _ = stages
+    for extractor in [*google_extractors, *crude_extractors]:
+        batch = getattr(extractor, "batch", None)
+        if batch:
+            batch(texts)
+
+
+def extract_info_batched(
+    raw_lines: Iterable[str], batch_size: int, threads: int = 1
+) -> Iterator[Entry]:
+    """
+    Extract batch_size lines at a time, first filling the cache for the whole
+    batch with the extractors that have a batch version (see Cache.batch_of),
+    e.g. Google packing many lines into one request, or NLTK tagging and chunking
+    all of their sentences in one pass.
+    """
+    for chunk in chunked(raw_lines, batch_size):
+        parsed_lines = [parse_line(raw_line) for raw_line in chunk]
+        prefetch([parsed.clean_line for parsed in parsed_lines if parsed.max_names])
+        if threads > 1:
+            yield from extract_info_threaded(parsed_lines, threads, extract_parsed_info)
+        else:
+            yield from map(extract_parsed_info, parsed_lines)
+
+
+WorkerResult = Tuple[List[Entry], CacheEntries, Dict[str, CacheStats], Records, Timings]
+
+
+def extract_infos_in_worker(
+    raw_lines: List[str], threads: int = 1, batch_size: int = 0
+) -> WorkerResult:
+    entries = list(extract_entries(raw_lines, threads=threads, batch_size=batch_size))
+    return (
+        entries,
+        cache.pop_new_entries(),
+        cache.pop_stats(),
+        strategy_stats.pop_new_records(),
+        instruments.pop_timings(),
+    )
+
+
+def merge_worker_result(result: WorkerResult) -> List[Entry]:
+    entries, new_entries, stats, strategy_records, timings = result
+    cache.merge(new_entries)
+    cache.merge_stats(stats)
+    strategy_stats.merge(strategy_records)
+    instruments.merge_timings(timings)
+    return entries
+
+
+def chunked(items: Iterable[X], size: int) -> Iterator[List[X]]:
+    iterator = iter(items)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def extract_info_parallel(
+    raw_lines: Iterable[str], workers: int, threads: int = 1, batch_size: int = 0
+) -> Iterator[Entry]:
+    """
+    Fan lines out to a process pool, yielding entries in the same order as the
+    lines and merging each worker's new cache entries back into the shared cache.
+
+    Only a couple of chunks per worker are read ahead, so lines can be streamed.
+    Each chunk is a batch, if batching.
+    """
+    chunksize = batch_size or 16
+    # workers order strategies by what the parent knew when they started
+    strategy_records = dict(strategy_stats.records) if strategy_stats.adaptive else None
+    with ProcessPoolExecutor(
+        workers,
+        initializer=init_worker,
+        initargs=(models.offline, strategy_records, cache.settings()),
+    ) as executor:
+        extract_chunk = partial(
+            extract_infos_in_worker, threads=threads, batch_size=batch_size
+        )
+        results = imap_bounded(
+            executor, extract_chunk, chunked(raw_lines, chunksize), workers * 2
+        )
+        for result in results:
+            yield from merge_worker_result(result)
+
+
+async def extract_info_pipelined(
+    raw_lines: Iterable[str],
+    threads: int = 1,
+    window: int = 64,
+    stages: Stages = STAGES,
+) -> AsyncIterator[Entry]:
+    """
+    Extract lines in an asyncio pipeline: each line is parsed, then its first
+    Google extraction is requested, then the rest of it (NLTK, and any other
+    extractors it needs) runs. Parsing and extracting run in one CPU thread and
+    the requests in threads more, so the CPU works on other lines during each
+    round trip and the pipeline goes as fast as its slowest stage.
+
+    Up to window lines are in the pipeline at once, and entries come out in order.
+    """
+    loop = asyncio.get_running_loop()
+    # tasks for the lines in the pipeline, in order, None once there are no more
+    pending: "asyncio.Queue[Optional[asyncio.Future]]" = asyncio.Queue(window)
+    with ThreadPoolExecutor(1) as cpu, ThreadPoolExecutor(threads) as network:
+
+        async def extract(raw_line: str) -> Entry:
+            parsed = await loop.run_in_executor(cpu, parse_line, raw_line)
+            if parsed.max_names:
+                # every line with contacts needs it, the cache has it for later
+                google_extractor = strategy_stats.order(stages[0])[0]
+                # through strategy_stats, so the try after it isn't nearly free
+                prefetch = partial(strategy_stats.prefetch, google_extractor)
+                await loop.run_in_executor(network, prefetch, parsed.clean_line)
+            return await loop.run_in_executor(
+                cpu, partial(extract_parsed_info, parsed, stages=stages)
+            )
+
+        async def feed() -> None:
+            for raw_line in raw_lines:
+                # waits while the pipeline is full
+                await pending.put(asyncio.ensure_future(extract(raw_line)))
+            await pending.put(None)
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                yield await task
+            await feeder
+        finally:
+            feeder.cancel()
+
+
+def read_lines(in_file: IO) -> Iterator[str]:
+    rows = csv.reader(in_file)
+    next(rows, None)  # header
+    return (row[0] for row in rows)
+
+
+class OutputFormat(str, Enum):
+    "CSV with a row for each contact, or JSON Lines with an object for each entry"
+
+    csv = "csv"
+    jsonl = "jsonl"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+OUTPUT_NAMES = {
+    OutputFormat.csv: "data/info.csv",
+    OutputFormat.jsonl: "data/info.jsonl",
+}
+
+
+class EntryWriter:
+    """
+    Writes entries to out_file in output_format, buffering them in memory and
+    writing batch_size entries' worth in one go, instead of a write for every
+    row. Use it as a context manager, or call flush at the end.
+
+    CSV has a header before the first entry, unless header is False, e.g. when
+    appending. JSON Lines has the line itself rather than a list of it, so it
+    loads without reparsing the CSV or regrouping its rows.
+    """
+
+    def __init__(
+        self,
+        out_file: IO,
+        output_format: OutputFormat = OutputFormat.csv,
+        batch_size: int = 256,
+        header: bool = True,
+    ):
+        self.out_file = out_file
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.header = header and output_format == OutputFormat.csv
+        self.buffer = io.StringIO()
+        self.csv_writer = csv.writer(self.buffer)
+        self.buffered = 0
+
+    def __enter__(self) -> "EntryWriter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.flush()
+
+    def write(self, entry: Mapping[str, Names]) -> None:
+        entry = Entry.of(entry)
+        if self.output_format == OutputFormat.jsonl:
+            self.buffer.write(json.dumps(entry.to_json(), ensure_ascii=False) + "\n")
+        else:
+            if self.header:
+                self.csv_writer.writerow(entry.keys())
+                self.header = False
+            self.csv_writer.writerows(entry.rows())
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffered:
+            self.out_file.write(self.buffer.getvalue())
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.buffered = 0
+
+
+def save_entries(
+    entries: Iterable[Mapping[str, Names]],
+    out_file: IO,
+    output_format: OutputFormat = OutputFormat.csv,
+) -> None:
+    with EntryWriter(out_file, output_format) as writer:
+        for entry in entries:
+            writer.write(entry)
+
+
+def stream_entries(
+    entries: Iterable[E], out_file: IO, output_format: OutputFormat = OutputFormat.csv
+) -> Iterator[E]:
+    """
+    Write entries as they're extracted, a batch at a time, and pass them along.
+    Everything up to the last batch is written if extraction fails.
+    """
+    with EntryWriter(out_file, output_format) as writer:
+        for entry in entries:
+            writer.write(entry)
+            yield entry
 
 
 class EntryType(str, Enum):
@@ -159,6 +667,22 @@ def decide_entry_type(entry: Entry) -> Sequence[EntryType]:
     return (EntryType.all, EntryType.incorrect)
 
 
+def print_metrics(counts: Mapping[EntryType, int]) -> None:
+    for entry_type in list(EntryType):
+        fraction = counts[entry_type] / counts[EntryType.all]
+        print("{}: {:.2%}. ".format(entry_type, fraction), end="")
+    print()
+
+
+def count_entry_types(entries: Iterable[Entry]) -> Dict[EntryType, int]:
+    "Like analyze_metrics, but only keeps running counts instead of the entries."
+    counts = dict.fromkeys(EntryType, 0)
+    for entry in entries:
+        for entry_type in decide_entry_type(entry):
+            counts[entry_type] += 1
+    return counts
+
+
 def analyze_metrics(entries: List[Entry]) -> Tuple[Mapping, Mapping]:
     typed_entries = [(decide_entry_type(entry), entry) for entry in entries]
     entries_by_type = {
@@ -170,22 +694,406 @@ def analyze_metrics(entries: List[Entry]) -> Tuple[Mapping, Mapping]:
         for entry_type_being_found in EntryType
     }
     counts = dict(zip(entries_by_type.keys(), map(len, entries_by_type.values())))
-    for entry_type in list(EntryType):
-        fraction = counts[entry_type] / counts[EntryType.all]
-        print("{}: {:.2%}. ".format(entry_type, fraction), end="")
-    print()
+    print_metrics(counts)
     return (entries_by_type, counts)
 
 
-def main() -> Tuple[Mapping, Mapping]:
+def extract_entries(
+    raw_lines: Iterable[str], workers: int = 1, threads: int = 1, batch_size: int = 0
+) -> Iterator[Entry]:
+    if workers > 1:
+        # load the models before any workers are forked, so that they share them.
+        # Otherwise they're loaded the first time a line needs them
+        models.warm_up()
+        return extract_info_parallel(raw_lines, workers, threads, batch_size)
+    if batch_size:
+        return extract_info_batched(raw_lines, batch_size, threads)
+    if threads > 1:
+        return extract_info_threaded(raw_lines, threads)
+    return map(extract_info, raw_lines)
+
+
+def main(
+    workers: int = 1,
+    threads: int = 1,
+    batch_size: int = 0,
+    output_format: OutputFormat = OutputFormat.csv,
+) -> Tuple[Mapping, Mapping]:
     with open("data/trello.csv", encoding="utf-8") as in_file:
         lines = list(csv.reader(in_file))[1:]
+    strategy_stats.load()
     with cache:
-        entries = [extract_info(line[0]) for line in lines]
-    with open("data/info.csv", "w", encoding="utf-8") as out_file:
-        save_entries(entries, out_file)
-    return analyze_metrics(entries)
+        raw_lines = (line[0] for line in lines)
+        entries = list(
+            instruments.track(
+                extract_entries(raw_lines, workers, threads, batch_size), len(lines)
+            )
+        )
+    strategy_stats.save()
+    with open(OUTPUT_NAMES[output_format], "w", encoding="utf-8") as out_file:
+        save_entries(entries, out_file, output_format)
+    metrics = analyze_metrics(entries)
+    cache.print_stats()
+    strategy_stats.print_stats()
+    return metrics
+
+
+def stream_main(
+    workers: int = 1,
+    threads: int = 1,
+    batch_size: int = 0,
+    output_format: OutputFormat = OutputFormat.csv,
+) -> Mapping[EntryType, int]:
+    """
+    Like main, but reads, extracts and writes one line at a time so memory stays
+    flat and a crash keeps everything up to the last batch written (see
+    EntryWriter). Only the counts are returned.
+    """
+    strategy_stats.load()
+    # line buffered so that each batch actually hits the disk once it's written
+    with open("data/trello.csv", encoding="utf-8") as in_file, open(
+        OUTPUT_NAMES[output_format], "w", encoding="utf-8", buffering=1
+    ) as out_file, cache:
+        entries = extract_entries(read_lines(in_file), workers, threads, batch_size)
+        counts = count_entry_types(
+            stream_entries(instruments.track(entries), out_file, output_format)
+        )
+    strategy_stats.save()
+    print_metrics(counts)
+    cache.print_stats()
+    strategy_stats.print_stats()
+    return counts
+
+
+CHECKPOINT_NAME = "data/info.csv.checkpoint"
+
+
+class Checkpoint(NamedTuple):
+    "What an incremental run wrote, to pick up from next time"
+
+    # changes whenever the extraction might, which makes the checkpoint stale
+    pipeline: str
+    counts: Dict[EntryType, int]
+    # the size of the output file, to tell if it's still the one that was written
+    output_size: int
+    # the hash_key of each row, and its entry
+    rows: List[Tuple[str, Entry]]
+
+
+def pipeline_fingerprint() -> str:
+    return fingerprint(extract_info, *chain.from_iterable(STAGES))
+
+
+def load_checkpoint(file_name: str = CHECKPOINT_NAME) -> Optional[Checkpoint]:
+    "Header line, then one JSON line for each row"
+    try:
+        with open(file_name, encoding="utf-8") as checkpoint_file:
+            header = json.loads(next(checkpoint_file))
+            rows = [
+                (key, Entry.from_json(entry))
+                for key, entry in map(json.loads, checkpoint_file)
+            ]
+    except (IOError, StopIteration, ValueError):
+        return None
+    counts = {EntryType(entry_type): count for entry_type, count in header["counts"]}
+    return Checkpoint(header["pipeline"], counts, header["output_size"], rows)
+
+
+def save_checkpoint(checkpoint: Checkpoint, file_name: str = CHECKPOINT_NAME) -> None:
+    header = {
+        "pipeline": checkpoint.pipeline,
+        "counts": [
+            [entry_type.value, count] for entry_type, count in checkpoint.counts.items()
+        ],
+        "output_size": checkpoint.output_size,
+    }
+    with open(file_name + ".tmp", "w", encoding="utf-8") as checkpoint_file:
+        checkpoint_file.write(json.dumps(header) + "\n")
+        for key, entry in checkpoint.rows:
+            checkpoint_file.write(json.dumps([key, Entry.of(entry).to_json()]) + "\n")
+    os.replace(file_name + ".tmp", file_name)
+
+
+def patch_output(
+    out_name: str,
+    previous: Checkpoint,
+    rows: List[Tuple[str, Entry]],
+    output_format: OutputFormat = OutputFormat.csv,
+) -> int:
+    """
+    Append the entries of new rows to out_name if the rows before them are the
+    ones it was written with, otherwise rewrite it. Returns its new size.
+    """
+    appending = (
+        bool(previous.rows)
+        and os.path.exists(out_name)
+        and os.path.getsize(out_name) == previous.output_size
+        and [key for key, _ in rows[: len(previous.rows)]]
+        == [key for key, _ in previous.rows]
+    )
+    with open(out_name, "a" if appending else "w", encoding="utf-8") as out_file:
+        start = len(previous.rows) if appending else 0
+        with EntryWriter(out_file, output_format, header=not appending) as writer:
+            for _, entry in rows[start:]:
+                writer.write(entry)
+    return os.path.getsize(out_name)
+
+
+def incremental_main(
+    workers: int = 1,
+    threads: int = 1,
+    batch_size: int = 0,
+    in_name: str = "data/trello.csv",
+    out_name: Optional[str] = None,
+    checkpoint_name: str = CHECKPOINT_NAME,
+    output_format: OutputFormat = OutputFormat.csv,
+) -> Mapping[EntryType, int]:
+    """
+    Like main, but only extracts the rows that are new or changed since the last
+    incremental run, reusing the entries of the rest from its checkpoint, and
+    updates the counts by the rows that were added and removed. If only rows were
+    added at the end, their entries are appended to the output.
+
+    The checkpoint is ignored if the extraction code has changed since.
+    """
+    with open(in_name, encoding="utf-8") as in_file:
+        lines = list(read_lines(in_file))
+    row_keys = [hash_key(line) for line in lines]
+    pipeline = pipeline_fingerprint()
+    previous = load_checkpoint(checkpoint_name)
+    if previous is None or previous.pipeline != pipeline:
+        previous = Checkpoint(pipeline, dict.fromkeys(EntryType, 0), 0, [])
+    entries = dict(previous.rows)
+    new_lines = {key: line for key, line in zip(row_keys, lines) if key not in entries}
+    strategy_stats.load()
+    with cache:
+        new_entries = extract_entries(new_lines.values(), workers, threads, batch_size)
+        entries.update(zip(new_lines, instruments.track(new_entries, len(new_lines))))
+    strategy_stats.save()
+    counts = dict(previous.counts)
+    previous_keys = Counter(key for key, _ in previous.rows)
+    current_keys = Counter(row_keys)
+    for sign, changed in [
+        (-1, previous_keys - current_keys),
+        (1, current_keys - previous_keys),
+    ]:
+        for key, times in changed.items():
+            for entry_type in decide_entry_type(entries[key]):
+                counts[entry_type] += sign * times
+    rows = [(key, entries[key]) for key in row_keys]
+    out_name = out_name or OUTPUT_NAMES[output_format]
+    output_size = patch_output(out_name, previous, rows, output_format)
+    save_checkpoint(Checkpoint(pipeline, counts, output_size, rows), checkpoint_name)
+    print(f"extracted {len(new_lines)} new or changed rows out of {len(rows)}")
+    print_metrics(counts)
+    cache.print_stats()
+    strategy_stats.print_stats()
+    return counts
+
+
+async def stream_pipelined(
+    raw_lines: Iterable[str],
+    out_file: IO,
+    threads: int = 1,
+    output_format: OutputFormat = OutputFormat.csv,
+) -> Dict[EntryType, int]:
+    "stream_entries and count_entry_types for extract_info_pipelined"
+    counts = dict.fromkeys(EntryType, 0)
+    progress = instruments.start_progress()
+    with EntryWriter(out_file, output_format) as writer:
+        async for entry in extract_info_pipelined(raw_lines, threads):
+            writer.write(entry)
+            for entry_type in decide_entry_type(entry):
+                counts[entry_type] += 1
+            progress.update()
+    progress.finish()
+    return counts
+
+
+def pipeline_main(
+    threads: int = 1, output_format: OutputFormat = OutputFormat.csv
+) -> Mapping[EntryType, int]:
+    """
+    Like stream_main, but extracts lines in an asyncio pipeline that keeps up to
+    threads Google requests in flight (see extract_info_pipelined).
+    """
+    strategy_stats.load()
+    with open("data/trello.csv", encoding="utf-8") as in_file, open(
+        OUTPUT_NAMES[output_format], "w", encoding="utf-8", buffering=1
+    ) as out_file, cache:
+        counts = asyncio.run(
+            stream_pipelined(read_lines(in_file), out_file, threads, output_format)
+        )
+    strategy_stats.save()
+    print_metrics(counts)
+    cache.print_stats()
+    strategy_stats.print_stats()
+    return counts
+
+
+def export_instrumentation(
+    file_name: str, stage_names: List[str] = STAGE_NAMES
+) -> None:
+    """
+    instruments' timings, progress and profile, with cache hits and misses for each
+    function and added up by stage, and each strategy's record
+    """
+    stages = {
+        strategy.__name__: stage_name
+        for stage_name, stage in zip(stage_names, STAGES)
+        for strategy in stage
+    }
+    stage_stats: Dict[str, CacheStats] = defaultdict(CacheStats)
+    for func_name, stats in cache.stats.items():
+        stage_stats[stages.get(func_name, "other")].merge(stats)
+    instruments.export(
+        file_name,
+        cache={
+            "functions": {name: asdict(stats) for name, stats in cache.stats.items()},
+            "stages": {name: asdict(stats) for name, stats in stage_stats.items()},
+        },
+        strategies={
+            name: asdict(record) for name, record in strategy_stats.records.items()
+        },
+    )
 
 
 if __name__ == "__main__":
-    metrics = main()
+    parser = argparse.ArgumentParser(
+        description="Extract names and contact info from data/trello.csv"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes to extract lines with (default: 1, serial)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="number of lines each process extracts at once, so that their Google "
+        "requests overlap (default: 1)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="extract this many lines at a time, packing their Google requests "
+        "together and running NLTK over all of them at once (default: 0, one line "
+        "at a time)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write each entry as it's extracted, keeping only running metrics",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="like --stream, but parse and extract lines while other lines' Google "
+        "requests (--threads of them at once) are in flight",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only extract rows that are new or changed since the last incremental "
+        "run, keeping the rest of the output (see incremental_main)",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=OutputFormat,
+        choices=list(OutputFormat),
+        default=OutputFormat.csv,
+        help="write data/info.csv, or data/info.jsonl with a JSON object for each "
+        "line (default: csv)",
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        help="evict the least recently used cached results past this many",
+    )
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        help="evict the least recently used cached results past this size",
+    )
+    parser.add_argument(
+        "--cache-eviction",
+        type=Eviction,
+        choices=list(Eviction),
+        default=Eviction.lru,
+        help="apply the cache limits to all functions together or to each one",
+    )
+    parser.add_argument(
+        "--hash-cache-keys",
+        action="store_true",
+        help="store digests of lines in the cache instead of the lines, which makes "
+        "it smaller on disk (not in memory), but misses results cached without this",
+    )
+    parser.add_argument(
+        "--offline-models",
+        action="store_true",
+        help="fail at startup if NLTK models are missing instead of downloading "
+        "them later",
+    )
+    parser.add_argument(
+        "--deterministic-order",
+        action="store_true",
+        help="try strategies in the order they're listed in strategies.py, instead "
+        "of the order that's found answers fastest on previous lines and runs",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=1.0,
+        help="seconds between updates of the progress line on stderr, 0 for none "
+        "(default: 1)",
+    )
+    parser.add_argument(
+        "--profile-every",
+        type=int,
+        default=0,
+        help="cProfile every nth line extracted, except in --workers (default: 0, "
+        "none)",
+    )
+    parser.add_argument(
+        "--instrument-json",
+        help="write timings for each strategy and line, cache hits and misses for "
+        "each stage, throughput and any profile to this JSON file",
+    )
+    args = parser.parse_args()
+    if args.pipeline and (args.workers > 1 or args.batch_size):
+        parser.error(
+            "--pipeline runs in one process, one line at a time, so it can't be "
+            "combined with --workers or --batch-size"
+        )
+    models.offline = args.offline_models
+    try:
+        models.check()
+    except ModelsMissing as error:
+        parser.error(str(error))
+    strategy_stats.adaptive = not args.deterministic_order
+    cache.max_entries = args.cache_max_entries
+    cache.max_bytes = args.cache_max_bytes
+    cache.eviction = args.cache_eviction
+    cache.hash_keys = args.hash_cache_keys
+    instruments.progress_interval = args.progress_interval
+    instruments.profile_every = args.profile_every
+    if args.incremental:
+        metrics = incremental_main(
+            args.workers,
+            args.threads,
+            args.batch_size,
+            output_format=args.output_format,
+        )
+    elif args.pipeline:
+        metrics = pipeline_main(args.threads, args.output_format)
+    elif args.stream:
+        metrics = stream_main(
+            args.workers, args.threads, args.batch_size, args.output_format
+        )
+    else:
+        metrics = main(args.workers, args.threads, args.batch_size, args.output_format)
+    if args.instrument_json:
+        export_instrumentation(args.instrument_json)
@@ -0,0 +1,240 @@
+"""
+Cheap enough to leave on for every line: timing histograms by name (each
+strategy, and each line as a whole), a progress line with throughput and ETA
+that's rewritten at most once per interval, and cProfile around every nth line.
+Everything can be exported as JSON at the end of a run.
+"""
+
+import sys
+import json
+import math
+import time
+import pstats
+import cProfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, DefaultDict, Dict, IO, Iterable, Iterator, List, Optional
+from typing import TypeVar
+
+X = TypeVar("X")
+
+
+class Histogram:
+    """
+    Counts of timings in buckets 2 ** (1 / 4) apart, from a microsecond up, so
+    percentiles are within 19% in constant space, and histograms add up.
+    """
+
+    FACTOR = 2 ** 0.25
+    SMALLEST = 1e-6
+
+    def __init__(self) -> None:
+        self.buckets: DefaultDict[int, int] = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        bucket = 0
+        if seconds > self.SMALLEST:
+            bucket = math.ceil(math.log(seconds / self.SMALLEST, self.FACTOR))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        "An upper bound, within a bucket, of the timing fraction of them are under"
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= fraction * self.count:
+                return min(self.SMALLEST * self.FACTOR ** bucket, self.max)
+        return self.max
+
+    def merge(self, other: "Histogram") -> None:
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def to_json(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / (self.count or 1),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+Timings = Dict[str, Histogram]
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+class Progress:
+    """
+    Lines done, lines per second and, if the total is known, the time left, on
+    one line of out that's rewritten at most every interval seconds. An interval
+    of 0 doesn't write anything.
+    """
+
+    def __init__(
+        self, total: Optional[int] = None, interval: float = 1.0, out: IO = sys.stderr
+    ):
+        self.total = total
+        self.interval = interval
+        self.out = out
+        self.count = 0
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+        self.next_report = self.start + interval
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def rate(self) -> float:
+        return self.count / (self.elapsed or 1e-9)
+
+    def update(self, count: int = 1) -> None:
+        self.count += count
+        if self.interval and time.monotonic() >= self.next_report:
+            self.next_report = time.monotonic() + self.interval
+            self.report()
+
+    def report(self) -> None:
+        total = f"/{self.total:,}" if self.total is not None else ""
+        text = f"{self.count:,}{total} lines, {self.rate:,.1f} lines/s"
+        if self.total is not None and self.rate:
+            text += f", ETA {format_duration((self.total - self.count) / self.rate)}"
+        self.out.write(f"\r{text}")
+        self.out.flush()
+
+    def finish(self) -> None:
+        self.end = time.monotonic()
+        if self.interval:
+            self.report()
+            self.out.write("\n")
+
+
+class Instruments:
+    """
+    Timings by name, the progress of the last run, and a profile of every
+    profile_every-th line that runs in this process (so not with --workers), one
+    at a time if lines run in threads. 0 doesn't profile.
+    """
+
+    def __init__(self, progress_interval: float = 1.0, profile_every: int = 0):
+        self.progress_interval = progress_interval
+        self.profile_every = profile_every
+        self.timings: DefaultDict[str, Histogram] = defaultdict(Histogram)
+        self.progress: Optional[Progress] = None
+        self.profiler = cProfile.Profile()
+        self.profiled = 0
+        self.lines = 0
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()
+
+    def time(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.timings[name].add(seconds)
+
+    @contextmanager
+    def line(self) -> Iterator[None]:
+        "Time a line under 'line', and profile it if it's its turn"
+        with self.lock:
+            self.lines += 1
+            profile = bool(self.profile_every) and not self.lines % self.profile_every
+        # cProfile can't profile two threads at once
+        profile = profile and self.profiling.acquire(blocking=False)
+        start = time.perf_counter()
+        if profile:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                self.profiler.disable()
+                self.profiled += 1
+                self.profiling.release()
+            self.time("line", time.perf_counter() - start)
+
+    def track(self, items: Iterable[X], total: Optional[int] = None) -> Iterator[X]:
+        "Report progress as items are taken"
+        progress = self.start_progress(total)
+        for item in items:
+            yield item
+            progress.update()
+        progress.finish()
+
+    def start_progress(self, total: Optional[int] = None) -> Progress:
+        self.progress = Progress(total, self.progress_interval)
+        return self.progress
+
+    def pop_timings(self) -> Timings:
+        with self.lock:
+            timings, self.timings = self.timings, defaultdict(Histogram)
+        return dict(timings)
+
+    def merge_timings(self, timings: Timings) -> None:
+        with self.lock:
+            for name, histogram in timings.items():
+                self.timings[name].merge(histogram)
+
+    def profile_stats(self, limit: int = 30) -> List[Dict[str, Any]]:
+        "The functions that took longest in the profiled lines, including calls"
+        if not self.profiled:
+            return []
+        stats = pstats.Stats(self.profiler)
+        functions = sorted(
+            stats.stats.items(),  # type: ignore
+            key=lambda item: item[1][3],
+            reverse=True,
+        )
+        return [
+            {
+                "function": f"{file_name}:{line}({name})",
+                "calls": calls,
+                "own": own_time,
+                "cumulative": cumulative_time,
+            }
+            for (file_name, line, name), (_, calls, own_time, cumulative_time, _) in (
+                functions[:limit]
+            )
+        ]
+
+    def report(self) -> Dict[str, Any]:
+        report: Dict[str, Any] = {
+            "timings": {name: timing.to_json() for name, timing in self.timings.items()}
+        }
+        if self.progress:
+            report["progress"] = {
+                "lines": self.progress.count,
+                "seconds": self.progress.elapsed,
+                "lines_per_second": self.progress.rate,
+            }
+        if self.profiled:
+            report["profile"] = {
+                "lines": self.profiled,
+                "functions": self.profile_stats(),
+            }
+        return report
+
+    def export(self, file_name: str, **sections: Any) -> None:
+        "Write the report, and any other sections, as JSON"
+        with open(file_name, "w", encoding="utf-8") as report_file:
+            json.dump({**self.report(), **sections}, report_file, indent=1)
+
+
+instruments = Instruments()
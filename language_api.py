@@ -0,0 +1,200 @@
+"""
+Long-lived, thread safe client for the Google Cloud Natural Language API.
+
+Building a service re-fetches and parses the discovery document, and each
+service holds an httplib2 connection, which isn't thread safe. So every thread
+builds its service once and then reuses it, and its open connection, for all of
+its requests.
+
+Requests are rate limited to stay under the quota and transient errors are
+retried with exponential backoff. Texts that still fail are remembered for a
+while rather than retried on every line, and identical requests that are in
+flight at the same time are only sent once.
+"""
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, TypeVar
+import httplib2
+import googleapiclient.discovery
+from googleapiclient.errors import HttpError
+
+Response = Dict[str, Any]
+X = TypeVar("X")
+Y = TypeVar("Y")
+
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class Unavailable(Exception):
+    "A request kept failing with transient errors; try again later."
+
+
+class RateLimiter:
+    "Token bucket allowing rate requests per second on average, burst at once"
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, HttpError):
+        return error.resp.status in TRANSIENT_STATUSES
+    # dropped connections, timeouts
+    return isinstance(error, OSError)
+
+
+def is_text_error(error: Exception) -> bool:
+    "The request was rejected for its text, so sending it again won't help"
+    # an invalid API key is a 400 too
+    return (
+        isinstance(error, HttpError)
+        and error.resp.status == 400
+        and b"API_KEY_INVALID" not in error.content
+    )
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    "How long the server asked us to wait, if it did"
+    try:
+        return float(error.resp["retry-after"])  # type: ignore
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class LanguageClient:
+    """
+    discovery_url points the client at a stand-in server (see language_stub),
+    which isn't sent any credentials. max_workers bounds how many requests map
+    keeps in flight.
+
+    The default rate is the API's default quota of 600 requests per minute.
+    Transient errors are retried max_retries times, waiting backoff seconds and
+    then twice as long each time, unless the server says how long to wait. A
+    text that still fails raises Unavailable, and keeps raising it without
+    sending anything for failure_ttl seconds.
+    """
+
+    def __init__(
+        self,
+        discovery_url: Optional[str] = None,
+        max_workers: int = 16,
+        requests_per_second: float = 10.0,
+        burst: int = 10,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        failure_ttl: float = 300.0,
+    ):
+        self.discovery_url = discovery_url
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(requests_per_second, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failure_ttl = failure_ttl
+        self.local = threading.local()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.lock = threading.Lock()
+        # text -> when to try it again
+        self.failures: Dict[str, float] = {}
+        self.in_flight: Dict[str, Future] = {}
+
+    @property
+    def service(self) -> Any:
+        "This thread's service, built on first use"
+        try:
+            return self.local.service
+        except AttributeError:
+            pass
+        if self.discovery_url:
+            self.local.service = googleapiclient.discovery.build(
+                "language",
+                "v1",
+                discoveryServiceUrl=self.discovery_url,
+                http=httplib2.Http(),
+                cache_discovery=False,
+            )
+        else:
+            self.local.service = googleapiclient.discovery.build("language", "v1")
+        return self.local.service
+
+    def analyze_entities(self, text: str) -> Response:
+        with self.lock:
+            if self.failures.get(text, 0.0) > time.monotonic():
+                raise Unavailable(text)
+            self.failures.pop(text, None)
+            future = self.in_flight.get(text)
+            sending = future is None
+            if sending:
+                future = self.in_flight[text] = Future()
+        if not sending:
+            # another thread is already asking; share its answer (or error)
+            return future.result()  # type: ignore
+        try:
+            response = self.request(text)
+        except Exception as error:
+            future.set_exception(error)  # type: ignore
+            raise
+        else:
+            future.set_result(response)  # type: ignore
+            return response
+        finally:
+            with self.lock:
+                del self.in_flight[text]
+
+    def request(self, text: str) -> Response:
+        body = {
+            "document": {"type": "PLAIN_TEXT", "content": text},
+            "encoding_type": "UTF32",
+        }
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            request = self.service.documents().analyzeEntities(  # pylint: disable=no-member
+                body=body
+            )
+            try:
+                return request.execute()
+            except (HttpError, OSError) as error:
+                if not is_transient(error):
+                    raise
+                if attempt == self.max_retries:
+                    with self.lock:
+                        self.failures[text] = time.monotonic() + self.failure_ttl
+                    raise Unavailable(text) from error
+                # jitter keeps threads that failed together from retrying together
+                time.sleep(retry_after(error) or delay * random.uniform(0.5, 1.5))
+                delay *= 2
+        raise AssertionError("unreachable")
+
+    def map(self, func: Callable[[X], Y], items: Iterable[X]) -> Iterator[Y]:
+        "Run func, which makes requests, over items with max_workers in flight."
+        with self.lock:
+            if not self.executor:
+                self.executor = ThreadPoolExecutor(self.max_workers)
+        return self.executor.map(func, items)
+
+    def analyze_entities_many(self, texts: Iterable[str]) -> Iterator[Response]:
+        "Keep up to max_workers requests in flight, yielding responses in order."
+        return self.map(self.analyze_entities, texts)
+
+
+client = LanguageClient()
@@ -0,0 +1,138 @@
+"""
+Local stand-in for the Google Cloud Natural Language API, for tests and benchmarks.
+
+Serves a minimal discovery document and answers documents.analyzeEntities by
+calling every capitalized word that isn't all caps a PERSON, a lot like
+strategies.all_capitalized_extract_names.
+"""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+NAME_RE = re.compile(r"\b[A-Z][a-z]+\b")
+
+
+def discovery_document(root_url: str) -> Dict[str, Any]:
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "language:v1",
+        "name": "language",
+        "version": "v1",
+        "protocol": "rest",
+        "rootUrl": root_url,
+        "servicePath": "",
+        "batchPath": "batch",
+        "parameters": {},
+        "schemas": {
+            "AnalyzeEntitiesRequest": {"id": "AnalyzeEntitiesRequest", "type": "object"},
+            "AnalyzeEntitiesResponse": {
+                "id": "AnalyzeEntitiesResponse",
+                "type": "object",
+            },
+        },
+        "resources": {
+            "documents": {
+                "methods": {
+                    "analyzeEntities": {
+                        "id": "language.documents.analyzeEntities",
+                        "path": "v1/documents:analyzeEntities",
+                        "flatPath": "v1/documents:analyzeEntities",
+                        "httpMethod": "POST",
+                        "parameters": {},
+                        "parameterOrder": [],
+                        "request": {"$ref": "AnalyzeEntitiesRequest"},
+                        "response": {"$ref": "AnalyzeEntitiesResponse"},
+                    }
+                }
+            }
+        },
+    }
+
+
+def analyze_entities(content: str) -> Dict[str, Any]:
+    # UTF32 offsets are code point offsets, which is what str indexes by
+    entities = [
+        {
+            "name": match.group(),
+            "type": "PERSON",
+            "mentions": [
+                {"text": {"content": match.group(), "beginOffset": match.start()}}
+            ],
+        }
+        for match in NAME_RE.finditer(content)
+    ]
+    return {"entities": entities, "language": "en"}
+
+
+class LanguageStub:
+    """
+    Run the stand-in on localhost in a background thread, e.g.
+
+        with LanguageStub() as stub:
+            client = LanguageClient(discovery_url=stub.discovery_url)
+
+    latency is added to every analyzeEntities call to imitate the round trip.
+    errors are HTTP statuses to answer the first analyzeEntities calls with, e.g.
+    [429, 503] to imitate running into the quota and then a flaky backend.
+    """
+
+    def __init__(self, latency: float = 0.0, errors: Iterable[int] = ()):
+        self.latency = latency
+        self.errors = deque(errors)
+        self.requests: List[Dict[str, Any]] = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                self.respond(discovery_document(stub.root_url))
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.requests.append(body)
+                time.sleep(stub.latency)
+                try:
+                    status = stub.errors.popleft()
+                except IndexError:
+                    self.respond(analyze_entities(body["document"]["content"]))
+                else:
+                    self.respond({"error": {"code": status}}, status)
+
+            def respond(self, response: Dict[str, Any], status: int = 200) -> None:
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server.server_address[:2]  # type: ignore
+
+    @property
+    def root_url(self) -> str:
+        return "http://{}:{}/".format(*self.address)
+
+    @property
+    def discovery_url(self) -> str:
+        return self.root_url + "discovery/{api}/{apiVersion}"
+
+    def __enter__(self) -> "LanguageStub":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exception_info: Any) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,115 @@
+"""
+NLTK models, loaded once per process and kept resident.
+
+nltk.download checks the filesystem, and sometimes the network, every time it's
+called, and nltk.pos_tag unpickles the perceptron tagger on every call. The
+strategies use these models instead. warm_up loads them all up front; otherwise
+that happens the first time one is used.
+
+WordNet is only needed to build ambiguous_words, so it isn't loaded here.
+"""
+
+import threading
+from typing import Any, Dict, List, Tuple
+
+# nltk.download package -> resource nltk.data.find looks for
+PACKAGES = {
+    "punkt": "tokenizers/punkt",
+    "averaged_perceptron_tagger": "taggers/averaged_perceptron_tagger",
+    "maxent_ne_chunker": "chunkers/maxent_ne_chunker",
+    "words": "corpora/words",
+}
+WORDNET = {"wordnet": "corpora/wordnet"}
+
+
+class ModelsMissing(LookupError):
+    pass
+
+
+def is_installed(resource: str) -> bool:
+    import nltk
+
+    try:
+        nltk.data.find(resource)
+    except LookupError:
+        return False
+    return True
+
+
+class Models:
+    """
+    With offline, missing models raise ModelsMissing instead of being downloaded,
+    e.g. for workers on machines that were set up ahead of time. check finds
+    out whether they would be without loading them.
+    """
+
+    def __init__(self, offline: bool = False):
+        self.offline = offline
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def warm_up(self) -> "Models":
+        with self.lock:
+            if not self.loaded:
+                self.load()
+                self.loaded = True
+        return self
+
+    def check(self) -> None:
+        "With offline, raise ModelsMissing now instead of mid-run, without loading"
+        if self.offline:
+            self.install(PACKAGES)
+
+    def install(self, packages: Dict[str, str]) -> None:
+        import nltk
+
+        missing = [
+            package
+            for package, resource in packages.items()
+            if not is_installed(resource)
+        ]
+        if missing and self.offline:
+            packages = " ".join(missing)
+            raise ModelsMissing(
+                f"missing NLTK models, install with: python -m nltk.downloader {packages}"
+            )
+        for package in missing:
+            nltk.download(package, quiet=True, raise_on_error=True)
+
+    def load(self) -> None:
+        import nltk
+
+        self.install(PACKAGES)
+        self.sentence_tokenizer = nltk.data.load("tokenizers/punkt/english.pickle")
+        self.word_tokenizer = nltk.word_tokenize
+        self.tagger = nltk.tag.PerceptronTagger()
+        self.chunker = nltk.data.load(
+            "chunkers/maxent_ne_chunker/english_ace_multiclass.pickle"
+        )
+
+    def sent_tokenize(self, text: str) -> List[str]:
+        return self.warm_up().sentence_tokenizer.tokenize(text)
+
+    def word_tokenize(self, text: str) -> List[str]:
+        return self.warm_up().word_tokenizer(text)
+
+    def pos_tag(self, tokens: List[str]) -> List[Tuple[str, str]]:
+        return self.warm_up().tagger.tag(tokens)
+
+    def ne_chunk(self, tagged: List[Tuple[str, str]]) -> Any:
+        return self.warm_up().chunker.parse(tagged)
+
+    def pos_tag_sents(self, sentences: List[List[str]]) -> List[List[Tuple[str, str]]]:
+        return self.warm_up().tagger.tag_sents(sentences)
+
+    def ne_chunk_sents(self, tagged_sentences: List[List[Tuple[str, str]]]) -> Any:
+        return self.warm_up().chunker.parse_sents(tagged_sentences)
+
+    def wordnet(self) -> Any:
+        import nltk
+
+        self.install(WORDNET)
+        return nltk.corpus.wordnet
+
+
+models = Models()
@@ -1,11 +1,25 @@
+import re
 import string
-from itertools import combinations, filterfalse
-from functools import reduce
-from typing import List, Callable, Sequence, Tuple, TypeVar
+from bisect import bisect_right
+from itertools import chain, combinations, compress, filterfalse, islice
+from functools import partial, lru_cache
+from typing import (
+    Any,
+    List,
+    Callable,
+    Iterable,
+    NamedTuple,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Iterator,
+)
 from typing_extensions import Protocol, runtime_checkable
-import googleapiclient.discovery
 from googleapiclient.errors import HttpError
-from cache import cache
+from cache import cache, Uncached
+import language_api
+from nltk_models import models
+from ambiguous_words import ambiguous_words
 
 X = TypeVar("X")
 Y = TypeVar("Y")
@@ -40,26 +54,74 @@ def compose(f: Callable[[Y], Z], g: Callable[[X], Y]) -> Callable[[X], Z]:
 Names = List[str]
 
 
-def contains_nonlatin(text: str) -> bool:
-    return not all(map(string.printable.__contains__, text))
-    # .84usec faster pcall than using a comprehension
-    # read as "not all of the characters are in the ASCII set"
+NONPRINTABLE_RE = re.compile("[^{}]".format(re.escape(string.printable)))
 
 
-@cache.with_cache
-def nltk_extract_names(text: str) -> Names:
-    "Returns names using NLTK Named Entity Recognition filtering repetition"
-    import nltk
+def contains_nonlatin(text: str) -> bool:
+    return NONPRINTABLE_RE.search(text) is not None
+    # several times faster than all(map(string.printable.__contains__, text)),
+    # which was .84usec faster than using a comprehension
+    # read as "some character isn't in the ASCII set"
+
+
+ONLY_ALPHA_PUNCTUATION = r"-/\$%(),.:;?!"
+# so that words with only letters and that punctuation are .isalpha()
+PUNCTUATION_TO_LETTERS = str.maketrans(
+    ONLY_ALPHA_PUNCTUATION, "a" * len(ONLY_ALPHA_PUNCTUATION)
+)
+
+
+class LineAnalysis(NamedTuple):
+    "The ways strategies look at the words of a text, so each is only done once"
+
+    text: str
+    words: List[str]
+    # each word with just its letters
+    alpha_words: List[str]
+    capitalized: List[bool]
+    # the words with only letters and some punctuation
+    only_alpha_words: List[str]
+    nonlatin: bool
+
+    @property
+    def printable(self) -> str:
+        if not self.nonlatin:
+            return self.text
+        return NONPRINTABLE_RE.sub("", self.text)
+
+
+# lines are extracted a few at a time at most, and each of their strategies
+# analyzes them and their preprocessed versions
+@lru_cache(maxsize=256)
+def analyze(text: str) -> LineAnalysis:
+    words = text.split()
+    alpha_words = ["".join(filter(str.isalpha, word)) for word in words]
+    return LineAnalysis(
+        text=text,
+        words=words,
+        alpha_words=alpha_words,
+        # McCall is a name, but ELISEVER isn't
+        capitalized=[
+            bool(word) and word[0].isupper() and not word.isupper()
+            for word in alpha_words
+        ],
+        only_alpha_words=list(
+            compress(
+                words,
+                map(str.isalpha, text.translate(PUNCTUATION_TO_LETTERS).split()),
+            )
+        ),
+        nonlatin=contains_nonlatin(text),
+    )
 
-    nltk.download("maxent_ne_chunker")
-    nltk.download("averaged_perceptron_tagger")
-    nltk.download("punkt")
-    nltk.download("words")
+
+def person_names(chunked_sentences: Iterable[Any]) -> Names:
     names = [
         " ".join(labeled[0] for labeled in chunk)
-        for sentance in nltk.sent_tokenize(text)
-        for chunk in nltk.ne_chunk(nltk.pos_tag(nltk.word_tokenize(sentance)))
-        if isinstance(chunk, nltk.tree.Tree) and chunk.label() == "PERSON"
+        for chunked_sentance in chunked_sentences
+        for chunk in chunked_sentance
+        # chunks are Trees, plain words are tuples
+        if hasattr(chunk, "label") and chunk.label() == "PERSON"
     ]
     # remove any names that contain each other
     duplicate_names = [
@@ -70,10 +132,34 @@ def nltk_extract_names(text: str) -> Names:
     return list(set(names) - set(duplicate_names))
 
 
+@cache.with_cache
+def nltk_extract_names(text: str) -> Names:
+    "Returns names using NLTK Named Entity Recognition filtering repetition"
+    return person_names(
+        models.ne_chunk(models.pos_tag(models.word_tokenize(sentance)))
+        for sentance in models.sent_tokenize(text)
+    )
+
+
+@cache.batch_of(nltk_extract_names)
+def nltk_extract_names_batch(texts: List[str]) -> List[Names]:
+    "Like nltk_extract_names for each text, but tags and chunks every sentence at once"
+    sentances = [
+        [models.word_tokenize(sentance) for sentance in models.sent_tokenize(text)]
+        for text in texts
+    ]
+    chunked_sentances = iter(
+        models.ne_chunk_sents(models.pos_tag_sents(list(chain(*sentances))))
+    )
+    return [
+        person_names(islice(chunked_sentances, len(text_sentances)))
+        for text_sentances in sentances
+    ]
+
+
 def all_capitalized_extract_names(text: str) -> List[str]:
-    words = ("".join(filter(str.isalpha, word)) for word in text.split())
-    # McCall is a name, but ELISEVER isn't
-    return [word for word in words if word and word[0].isupper() and not word.isupper()]
+    analysis = analyze(text)
+    return list(compress(analysis.alpha_words, analysis.capitalized))
 
 
 Extractors = Sequence[Callable[[str], Names]]
@@ -82,36 +168,37 @@ CRUDE_EXTRACTORS: Extractors = [nltk_extract_names, all_capitalized_extract_name
 # try adding nltk_extract_names_only_alpha
 
 
-@cache.with_cache
-def google_extract_names(raw_text: str) -> Names:
-    "Return names using Google Cloud Knowledge Graph Named Entity Recognition."
-    text = "".join(filter(string.printable.__contains__, raw_text))
+def google_names(text: str) -> Names:
+    """
+    The PERSON entities Google finds in text. Only texts Google rejects (with a
+    400, e.g. for their language) get no names for good; errors that aren't
+    about the text, like credentials, billing or permissions, are raised.
+    """
     try:
-        body = {
-            "document": {"type": "PLAIN_TEXT", "content": text},
-            "encoding_type": "UTF32",
-        }
-        service = googleapiclient.discovery.build("language", "v1")
-        request = service.documents().analyzeEntities(  # pylint: disable=no-member
-            body=body
-        )
-        response = request.execute()
-    except HttpError:
-        return []
+        response = language_api.client.analyze_entities(text)
+    except language_api.Unavailable:
+        # try again next run
+        return Uncached([])  # type: ignore
+    except HttpError as error:
+        if language_api.is_text_error(error):
+            return []
+        raise
     return [
         entity["name"] for entity in response["entities"] if entity["type"] == "PERSON"
     ]
 
 
+@cache.with_cache
+def google_extract_names(raw_text: str) -> Names:
+    "Return names using Google Cloud Knowledge Graph Named Entity Recognition."
+    # not through analyze, so that editing it doesn't clear the paid results
+    return google_names(NONPRINTABLE_RE.sub("", raw_text))
+
+
 @cache.with_cache
 def only_alpha(text: str) -> str:
     "Remove words without any alphabetical chareceters or dashes."
-    words = [
-        word
-        for word in text.split()
-        if all(c.isalpha() or c in r"-/\$%(),.:;?!" for c in word)
-    ]
-    return " ".join(words)
+    return " ".join(analyze(text).only_alpha_words)
 
 
 def no_preprocess(text: str) -> str:
@@ -120,7 +207,7 @@ def no_preprocess(text: str) -> str:
 
 @cache.with_cache
 def every_name(text: str) -> str:
-    return "".join(map("My name is {}. ".format, only_alpha(text).split()))
+    return "".join(map("My name is {}. ".format, analyze(text).only_alpha_words))
 
 
 GOOGLE_PREPROCESSES: List[Callable[[str], str]] = [
@@ -133,22 +220,97 @@ GOOGLE_EXTRACTORS: Extractors = [
     compose(google_extract_names, preprocess) for preprocess in GOOGLE_PREPROCESSES
 ]
 
+# roughly how many characters to send per request when packing texts together
+PACK_CHARS = 5000
+PACK_SEPARATOR = "\n\n"
+
+
+def pack_texts(texts: Sequence[str], pack_chars: int) -> Iterator[List[str]]:
+    "Group consecutive texts so each group joined by PACK_SEPARATOR fits pack_chars"
+    pack: List[str] = []
+    length = 0
+    for text in texts:
+        if pack and length + len(PACK_SEPARATOR) + len(text) > pack_chars:
+            yield pack
+            pack, length = [], 0
+        length += bool(pack) * len(PACK_SEPARATOR) + len(text)
+        pack.append(text)
+    if pack:
+        yield pack
+
+
+def google_extract_packed_names(texts: List[str]) -> List[Names]:
+    """
+    Send texts as one document and map each PERSON mention back to the text it's in
+    by its offset. Mentions across a separator are dropped, and names that are
+    only found in other texts (Google merges mentions into one entity) are
+    replaced by the mention itself. If Google rejects the document for one of the
+    texts, they're sent one at a time, so only that one gets no names.
+    """
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text) + len(PACK_SEPARATOR)
+    try:
+        response = language_api.client.analyze_entities(PACK_SEPARATOR.join(texts))
+    except language_api.Unavailable:
+        return [Uncached([]) for _ in texts]  # type: ignore
+    except HttpError as error:
+        if not language_api.is_text_error(error):
+            raise
+        # find out which of the texts it was
+        return [google_names(text) for text in texts]
+    names: List[Names] = [[] for _ in texts]
+    for entity in response["entities"]:
+        if entity["type"] != "PERSON":
+            continue
+        for mention in entity.get("mentions", []):
+            # UTF32 offsets count code points, same as indexing a str
+            begin = mention["text"]["beginOffset"]
+            content = mention["text"]["content"]
+            i = bisect_right(starts, begin) - 1
+            if begin + len(content) > starts[i] + len(texts[i]):
+                continue
+            name = entity["name"] if entity["name"] in texts[i] else content
+            if name not in names[i]:
+                names[i].append(name)
+    return names
+
+
+def google_extract_names_packed(
+    raw_texts: List[str], preprocess: Callable[[str], str] = no_preprocess
+) -> List[Names]:
+    """
+    Like google_extract_names(preprocess(raw_text)) for each raw text, but packs
+    PACK_CHARS worth of texts into each request. Requests are billed per 1000
+    characters, rounded up, and most lines are much shorter than that.
+    """
+    texts = [NONPRINTABLE_RE.sub("", preprocess(raw_text)) for raw_text in raw_texts]
+    packs = pack_texts(texts, PACK_CHARS)
+    return [
+        names
+        for pack_names in language_api.client.map(google_extract_packed_names, packs)
+        for names in pack_names
+    ]
+
+
+for google_extractor, google_preprocess in zip(GOOGLE_EXTRACTORS, GOOGLE_PREPROCESSES):
+    cache.batch_of(google_extractor)(
+        partial(google_extract_names_packed, preprocess=google_preprocess)
+    )
+
 
 def remove_none(names: Names) -> Names:
     return names
 
 
-@cache.with_cache
 def remove_synonyms(names: Names) -> Names:
-    from nltk.corpus import wordnet  # if this is cached we don't need to import nltk
-    import nltk
-
-    nltk.download("wordnet")
-
+    ambiguous = ambiguous_words()
     return [
         name
         for name in names
-        if not any(len(wordnet.synsets(word)) > 1 for word in name.split())
+        if ambiguous.isdisjoint(name.lower().split())
         # note: will have synonyms for e.g. David (various dictionary-worthy Davids)
     ]
 
@@ -168,11 +330,40 @@ Refiners = Sequence[Callable[[Names], Names]]
 UNIQUE_REFINERS: Refiners = [remove_short, remove_synonyms, remove_nonlatin]
 
 
+@lru_cache(maxsize=256)
+def refine(
+    refiners: Tuple[Callable[[Names], Names], ...], names: Tuple[str, ...]
+) -> Tuple[str, ...]:
+    """
+    refiners[0](refiners[1](...(names))), remembering every step, so that
+    refining the same names with (f, h) and then (g, h) only runs h once
+    """
+    if not refiners:
+        return names
+    return tuple(refiners[0](list(refine(refiners[1:], names))))
+
+
+def compose_refiners(*refiners: Callable[[Names], Names]) -> Callable[[Names], Names]:
+    """
+    Like reduce(compose, refiners), but sharing the inner refinements with the
+    other compositions. Only the refiners themselves are cached.
+    """
+
+    def composed_refiner(names: Names) -> Names:
+        return list(refine(refiners, tuple(names)))
+
+    composed_refiner.__name__ = composed_refiner.__qualname__ = "_".join(
+        refiner.__name__ for refiner in refiners
+    )
+    return composed_refiner
+
+
 REFINERS: Refiners = [remove_none] + [
-    reduce(compose, combination)  # type: ignore # overly specific inferred signature
+    compose_refiners(*combination)
     for i in range(1, len(UNIQUE_REFINERS))
     for combination in combinations(UNIQUE_REFINERS, i)
 ]
 
 Stages = Tuple[Extractors, Extractors, Refiners]
 STAGES: Stages = (GOOGLE_EXTRACTORS, CRUDE_EXTRACTORS, REFINERS)
+STAGE_NAMES = ["google", "crude", "refine"]
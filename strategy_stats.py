@@ -0,0 +1,150 @@
+"""
+How long each strategy takes and how often it leads to an accepted answer, used
+to try the strategies of each stage in the order that's likely to find an answer
+soonest.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, DefaultDict, Dict, Sequence, TypeVar
+from cache import cache
+from instrumentation import instruments
+
+X = TypeVar("X")
+Y = TypeVar("Y")
+
+
+@dataclass
+class StrategyRecord:
+    tried: int = 0
+    accepted: int = 0
+    time: float = 0.0
+
+    @property
+    def acceptance_rate(self) -> float:
+        # (Laplace) smoothed, so one unlucky line doesn't send a strategy to the back
+        return (self.accepted + 1) / (self.tried + 2)
+
+    @property
+    def cost(self) -> float:
+        """
+        Mean time per answer. Trying strategies in increasing order of cost
+        minimizes the expected time to the first answer, if they succeed
+        independently. Strategies that haven't been tried cost nothing yet.
+        """
+        return self.time / (self.tried or 1) / self.acceptance_rate
+
+    def merge(self, other: "StrategyRecord") -> None:
+        self.tried += other.tried
+        self.accepted += other.accepted
+        self.time += other.time
+
+
+Records = Dict[str, StrategyRecord]
+
+
+class StrategyStats:
+    """
+    Records are kept by strategy name in file_name, next to the cache by default.
+
+    Unless adaptive, stages keep their order, so the strategies are always
+    tried the same way (see tests/test_integration.py).
+    """
+
+    def __init__(
+        self, file_name: str = cache.cache_name + ".strategies", adaptive: bool = False
+    ):
+        self.file_name = file_name
+        self.adaptive = adaptive
+        self.records: DefaultDict[str, StrategyRecord] = defaultdict(StrategyRecord)
+        # since the last pop, for workers to send back
+        self.new_records: DefaultDict[str, StrategyRecord] = defaultdict(StrategyRecord)
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        try:
+            with open(self.file_name, encoding="utf-8") as stats_file:
+                records = json.load(stats_file)
+        except FileNotFoundError:
+            return
+        self.records.clear()
+        for name, record in records.items():
+            self.records[name] = StrategyRecord(**record)
+
+    def save(self) -> None:
+        records = {name: asdict(record) for name, record in self.records.items()}
+        with open(self.file_name + ".tmp", "w", encoding="utf-8") as stats_file:
+            json.dump(records, stats_file, indent=1, sort_keys=True)
+        os.replace(self.file_name + ".tmp", self.file_name)
+
+    def update(self, name: str, **changes: Any) -> None:
+        change = StrategyRecord(**changes)
+        with self.lock:
+            self.records[name].merge(change)
+            self.new_records[name].merge(change)
+
+    def call(self, strategy: Callable[[X], Y], arg: X) -> Y:
+        start = time.perf_counter()
+        result = strategy(arg)
+        elapsed = time.perf_counter() - start
+        self.update(strategy.__name__, tried=1, time=elapsed)
+        instruments.time(strategy.__name__, elapsed)
+        return result
+
+    def prefetch(self, strategy: Callable[[X], Y], arg: X) -> Y:
+        """
+        Call strategy ahead of its try, e.g. to fill the cache for it, counting the
+        time toward that try instead of as one more
+        """
+        start = time.perf_counter()
+        result = strategy(arg)
+        elapsed = time.perf_counter() - start
+        self.update(strategy.__name__, time=elapsed)
+        instruments.time(strategy.__name__ + " prefetch", elapsed)
+        return result
+
+    def accept(self, *strategies: Callable) -> None:
+        for strategy in strategies:
+            self.update(strategy.__name__, accepted=1)
+
+    def order(self, strategies: Sequence[X]) -> Sequence[X]:
+        if not self.adaptive:
+            return strategies
+        # stable, so ties keep their order
+        return sorted(
+            strategies,
+            key=lambda strategy: self.records[strategy.__name__].cost,  # type: ignore
+        )
+
+    def pop_new_records(self) -> Records:
+        with self.lock:
+            new_records, self.new_records = self.new_records, defaultdict(
+                StrategyRecord
+            )
+        return dict(new_records)
+
+    def merge(self, records: Records) -> None:
+        for name, record in records.items():
+            with self.lock:
+                self.records[name].merge(record)
+
+    def print_stats(self) -> None:
+        row = "{:<50} {:>8} {:>9} {:>10} {:>10}"
+        print(row.format("strategy", "tried", "accepted", "mean s", "cost"))
+        for name, record in sorted(self.records.items(), key=lambda item: item[1].cost):
+            print(
+                row.format(
+                    name,
+                    record.tried,
+                    "{:.1%}".format(record.accepted / (record.tried or 1)),
+                    "{:.4f}".format(record.time / (record.tried or 1)),
+                    "{:.4f}".format(record.cost),
+                )
+            )
+
+
+strategy_stats = StrategyStats()
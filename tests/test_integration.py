@@ -1,11 +1,10 @@
 # mypy: disallow_untyped_decorators=False
 import logging
 import io
-import pdb
 import json
-from itertools import product
 from functools import wraps
-from typing import Mapping, List, Any, Tuple, Callable, Sequence, Iterable
+from typing import Mapping, List, Any, Tuple, Callable, Sequence, Iterable, Iterator
+from typing import Dict, Optional
 import pytest
 import strategies
 from cache import cache
@@ -20,66 +19,143 @@ STAGES: Sequence[Sequence[Callable]] = strategies.STAGES
 # they're callables here
 
 
-def generate_graph(
-    stages: List[List[str]]
-) -> Iterable[Tuple[State, Mapping[str, State]]]:
+def step(stages: Sequence[Sequence[str]], state: State) -> Optional[Tuple[str, State]]:
+    """
+    The state after state, and the strategy tried to get there, or None after the
+    last state. That's the next combination in order where a stage is only started
+    once the stages before it are: the first strategy of the next stage, or the
+    next strategy of the last stage that has one left, starting the stages after it
+    over.
     """
-    Yield a graph describing valid transitions between combinations of strategies.
+    started = state.index(0) if 0 in state else len(state)
+    # states[...][i] indexes stages[i], e.g. (1, 2, 3) is the 1st strategy of stage 0,
+    # the 2nd strategy of stage 1, and the 3rd strategy of stage 2
+    if started < len(state) and len(stages[started]) > 1:
+        return (stages[started][1], state[:started] + (1,) + state[started + 1 :])
+    for stage in reversed(range(started)):
+        strategy = state[stage] + 1
+        if strategy < len(stages[stage]):
+            zeros = (0,) * (len(state) - stage - 1)
+            return (stages[stage][strategy], state[:stage] + (strategy,) + zeros)
+    return None
+
+
+def transitions(stages: Sequence[Sequence[str]], state: State) -> Mapping[str, State]:
+    """
+    The valid transitions from state. From the state after it, or, if it hasn't
+    started every stage, the next strategy of the last stage it did start, if that
+    has one left, skipping the stage it hasn't started.
+    """
+    next_step = step(stages, state)
+    if next_step is None:
+        return {}
+    step_symbol, step_state = next_step
+    if 0 in state:
+        incremented_stage = state.index(0) - 1
+        # can't skip if there isn't a previous stage to increment
+        # nor if the previous stage has run out
+        if (
+            incremented_stage >= 0
+            and len(stages[incremented_stage]) > state[incremented_stage] + 1
+        ):
+            skip_symbol = stages[incremented_stage][state[incremented_stage] + 1]
+            skip_state = tuple(
+                {incremented_stage: strategy + 1, incremented_stage + 1: 0}.get(
+                    stage, strategy
+                )
+                for stage, strategy in enumerate(state)
+            )
+            return {step_symbol: step_state, skip_symbol: skip_state}
+    return {step_symbol: step_state}
+
+
+class StrategyGraph(Mapping[State, Mapping[str, State]]):
+    """
+    The valid transitions between combinations of strategies for each stage.
 
     extract_info.extract_names tries strategies in a way that corresponds to a
     Finate State Automata. At a given combination of strategies for each stage,
     it can either try the first strategy of the next stage, the next strategy of this
     stage, or, if this is the last strategy, can go to the next strategy of the
     previous stage.
+
+    Each state's transitions are only worked out the first time they're looked up,
+    so walking a trace takes time in the length of the trace, not in the number of
+    combinations, which grows as the product of the number of strategies in each
+    stage. Iterating goes through every state with transitions, in order.
     """
-    # states[...][i] indexes stages[i], e.g. (1, 2, 3) is the 1st strategy of stage 0, 
-    # the 2nd strategy of stage 1, and the 3rd strategy of stage 2
-    states = product(*(range(len(stage)) for stage in stages))
-    # zeros cannot be followed by zeros, we can't have started stage n+1 but not n
-    valid_states = [
-        state for state in states if not (0 in state and any(state[state.index(0) :]))
-    ]
-    for state, step_state in zip(valid_states[:-1], valid_states[1:]):
-        first_change = [
-            index
-            for index, strategy in enumerate(state)
-            if step_state[index] is not strategy
-        ][0]
-        step_symbol = stages[first_change][step_state[first_change]]
-        if 0 in state:
-            incremented_stage = state.index(0) - 1
-            # can't skip if there isn't a previous stage to increment
-            # nor if the previous stage has run out
-            if (
-                incremented_stage >= 0
-                and len(stages[incremented_stage]) > state[incremented_stage] + 1
-            ):
-                skip_symbol = stages[incremented_stage][state[incremented_stage] + 1]
-                skip_state = tuple(
-                    {incremented_stage: strategy + 1, incremented_stage + 1: 0}.get(
-                        stage, strategy
-                    )
-                    for stage, strategy in enumerate(state)
-                )
-                yield (state, {step_symbol: step_state, skip_symbol: skip_state})
-                continue
-        yield (state, {step_symbol: step_state})
+
+    def __init__(self, stages: Sequence[Sequence[str]]):
+        self.stages = stages
+        self.transitions: Dict[State, Mapping[str, State]] = {}
+
+    def __getitem__(self, state: State) -> Mapping[str, State]:
+        if state not in self.transitions:
+            self.transitions[state] = transitions(self.stages, state)
+        if not self.transitions[state]:
+            raise KeyError(state)
+        return self.transitions[state]
+
+    def __iter__(self) -> Iterator[State]:
+        state: State = (0,) * len(self.stages)
+        while state in self:
+            yield state
+            next_step = step(self.stages, state)
+            if next_step is None:
+                return
+            _, state = next_step
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def generate_graph(
+    stages: List[List[str]]
+) -> Iterable[Tuple[State, Mapping[str, State]]]:
+    "Yield each state of StrategyGraph(stages) with its transitions, in order"
+    graph = StrategyGraph(stages)
+    for state in graph:
+        yield (state, graph[state])
 
 
-# it's usually inconvenient to `up` all the way through the path; pdb++ hides this
-@pdb.hideframe  # type: ignore # mypy doesn't see pdb++
 def walk_graph(symbols: List[str], state: State, graph: Graph) -> State:
-    if not symbols:
-        return state
-    current_symbol, *next_symbols = symbols
-    try:
-        next_state = graph[state][current_symbol]
-    except KeyError:
-        raise Exception(
-            f"Can only go to {tuple(graph[state].keys())} from {state},"
-            f"not {current_symbol}"
+    """
+    Follow symbols through graph from state. extract_names doesn't call strategies
+    again for results it already has, so transitions on symbols that were already
+    seen can also be taken without a symbol. That can leave more than one state
+    the symbols could end in, so return the furthest.
+    """
+    first_seen: Dict[str, int] = {}
+    for position, symbol in enumerate(symbols):
+        first_seen.setdefault(symbol, position)
+    stack = [(0, state)]
+    visited = set()
+    furthest = (0, state)
+    exit_states = []
+    while stack:
+        position, state = stack.pop()
+        if position == len(symbols):
+            exit_states.append(state)
+            continue
+        if (position, state) in visited:
+            continue
+        visited.add((position, state))
+        furthest = max(furthest, (position, state))
+        transitions = graph.get(state, {})
+        stack.extend(
+            (position, next_state)
+            for symbol, next_state in transitions.items()
+            if first_seen.get(symbol, position) < position
         )
-    return walk_graph(next_symbols, next_state, graph)
+        if symbols[position] in transitions:
+            stack.append((position + 1, transitions[symbols[position]]))
+    if exit_states:
+        return max(exit_states)
+    position, state = furthest
+    raise Exception(
+        f"Can only go to {tuple(graph.get(state, {}).keys())} from {state}, "
+        f"not {symbols[position]}"
+    )
 
 
 class Logger:
@@ -103,26 +179,33 @@ class Logger:
         self.log.addHandler(logging.StreamHandler(self.stream))
 
 
+STRATEGY_NAMES: List[List[str]] = [
+    [""] + [strategy.__name__ for strategy in stage] for stage in STAGES
+]
+# shared by every traced example, so each state's transitions are worked out once
+STRATEGY_GRAPH = StrategyGraph(STRATEGY_NAMES)
+
+
 @pytest.fixture(name="traced_extract_info")
 def trace_extract_info() -> Callable:
-    strategy_names: List[List[str]] = [
-        [""] + [strategy.__name__ for strategy in stage] for stage in STAGES
-    ]
-    graph: Graph = {
-        state: transitions for state, transitions in generate_graph(strategy_names)
-    }
     initial_state = (0,) * len(STAGES)
     final_state = tuple(map(len, STAGES))
     logger = Logger()
     stages = tuple([logger.logged(strategy) for strategy in stage] for stage in STAGES)
 
     def traced_extract_info(*args: Any, **kwargs: Any) -> Any:
-        print(strategy_names)
+        print(STRATEGY_NAMES)
         logger.new_stream()
         result = extract_info(*args, stages=stages, **kwargs)
         entry_types = decide_entry_type(result)
-        trace = logger.stream.getvalue()
-        exit_state = walk_graph(trace.split(), initial_state, graph)
+        trace = logger.stream.getvalue().split()
+        extractions = [
+            symbol
+            for symbol in trace
+            if symbol in STRATEGY_NAMES[0] or symbol in STRATEGY_NAMES[1]
+        ]
+        assert len(extractions) == len(set(extractions)), "repeated an extractor"
+        exit_state = walk_graph(trace, initial_state, STRATEGY_GRAPH)
         if 0 in exit_state or exit_state is final_state:
             assert EntryType.incorrect in entry_types
         return result
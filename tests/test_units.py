@@ -1,10 +1,51 @@
 # mypy: disallow_untyped_decorators=False
-from typing import Any, List, Sequence
+import io
+import os
+import json
+import asyncio
+import time
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence
 import pytest
+from phonenumbers import PhoneNumberMatcher, format_number, PhoneNumberFormat
+from googleapiclient.errors import HttpError
 import strategies
 import extract_info
-from cache import cache
-from test_integration import generate_graph, save_cache
+import language_api
+import nltk_models
+import ambiguous_words
+import strategy_stats
+import instrumentation
+from language_api import LanguageClient, RateLimiter, Unavailable
+from language_stub import LanguageStub
+from cache import (
+    cache,
+    Cache,
+    Eviction,
+    Snapshot,
+    Uncached,
+    write_snapshot,
+    entries_to_records,
+    fingerprint,
+    hash_key,
+    record_size,
+)
+from test_integration import generate_graph, walk_graph, save_cache, Logger
+from test_integration import StrategyGraph
+
+
+@pytest.fixture(name="stats")
+def tmp_strategy_stats(monkeypatch: Any, tmp_path: Any) -> strategy_stats.StrategyStats:
+    "Record extract_info's strategy stats in tmp_path instead of data/"
+    stats = strategy_stats.StrategyStats(str(tmp_path / "strategies"))
+    monkeypatch.setattr(extract_info, "strategy_stats", stats)
+    return stats
+
+
+def keep(names: List[str]) -> List[str]:
+    return names
+
 
 number_of_limbs_owed_to_google: int
 
@@ -33,6 +74,291 @@ def test_cache() -> None:
     cache.clear_cache("machine_learning_powered_echo")
 
 
+def test_cache_new_entries(tmp_path: Any) -> None:
+    worker_cache = Cache(str(tmp_path / "cache.json"))
+
+    @worker_cache.with_cache
+    def parallel_echo(x: Any) -> Any:
+        return x
+
+    with worker_cache:
+        assert worker_cache.pop_new_entries() == {}  # not tracked outside of workers
+        worker_cache.track_new_entries()
+        parallel_echo("bar")
+        new_entries = worker_cache.pop_new_entries()
+        assert new_entries == {"bar": {"parallel_echo": "bar"}}
+        assert worker_cache.pop_new_entries() == {}
+        worker_cache.new_entries = None
+        worker_cache.clear_cache("parallel_echo")
+        worker_cache.merge(new_entries)
+        assert worker_cache.cache["bar"]["parallel_echo"] == "bar"
+
+
+def test_cache_log(tmp_path: Any) -> None:
+    cache_name = str(tmp_path / "cache.json")
+    log_cache = Cache(cache_name, compact_after=2)
+    echo = log_cache.with_cache(lambda x: x)
+    with log_cache:
+        for word in ["foo", "bar", "baz"]:
+            echo(word)
+        # results are on disk before exiting, as if we'd crashed here
+        crashed = Cache(cache_name)
+        crashed.load()
+        assert crashed.get("baz", "<lambda>") == "baz"
+        # foo and bar were compacted into the snapshot, baz is still in the log
+        log_cache.compaction.join()
+        assert dict(Snapshot(cache_name + ".snapshot")) == {
+            b"foo\0<lambda>": b'"foo"',
+            b"bar\0<lambda>": b'"bar"',
+        }
+        assert log_cache.get("baz", "<lambda>") == "baz"
+        log_cache.clear_cache("<lambda>")
+    reloaded = Cache(cache_name)
+    reloaded.load()
+    for word in ["foo", "bar", "baz"]:
+        with pytest.raises(KeyError):
+            reloaded.get(word, "<lambda>")
+
+
+def test_cache_eviction(tmp_path: Any) -> None:
+    cache_name = str(tmp_path / "cache.json")
+    bounded_cache = Cache(cache_name, max_entries=2)
+    echo = bounded_cache.with_cache(lambda x: x)
+    with bounded_cache:
+        echo("a")
+        echo("b")
+        echo("a")
+        echo("c")  # the third result triggers a compaction
+    assert set(dict(Snapshot(cache_name + ".snapshot"))) == {
+        b"a\0<lambda>",
+        b"c\0<lambda>",
+    }
+    stats = bounded_cache.stats["<lambda>"]
+    assert (stats.hits, stats.misses, stats.evictions) == (1, 3, 1)
+
+    per_function_cache = Cache(
+        str(tmp_path / "per_function.json"),
+        max_entries=1,
+        eviction=Eviction.per_function,
+    )
+    echo = per_function_cache.with_cache(lambda x: x)
+    shout = per_function_cache.with_cache(str.upper)
+    with per_function_cache:
+        for word in ["a", "b"]:
+            echo(word)
+            shout(word)
+        per_function_cache.start_compaction()
+    assert dict(Snapshot(per_function_cache.snapshot_name)) == {
+        b"b\0<lambda>": b'"b"',
+        b"b\0upper": b'"B"',
+    }
+
+
+def test_cache_batch_of(tmp_path: Any) -> None:
+    batch_cache = Cache(str(tmp_path / "cache.json"))
+    batches: List[List[str]] = []
+    shout = batch_cache.with_cache(str.upper)
+
+    @batch_cache.batch_of(shout)
+    def shout_all(words: List[str]) -> List[str]:
+        batches.append(words)
+        return [word.upper() for word in words]
+
+    with batch_cache:
+        shout("a")
+        assert shout.batch(["a", "b", "c", "b"]) == ["A", "B", "C", "B"]
+        assert batches == [["b", "c"]]
+        assert batch_cache.get("c", "upper") == "C"
+
+
+def test_cache_uncached(tmp_path: Any) -> None:
+    uncached_cache = Cache(str(tmp_path / "cache.json"))
+    calls: List[str] = []
+
+    @uncached_cache.with_cache
+    def flaky(text: str) -> Any:
+        calls.append(text)
+        return Uncached([]) if len(calls) == 1 else [text]
+
+    with uncached_cache:
+        assert flaky("a") == []
+        assert flaky("a") == ["a"]
+        assert flaky("a") == ["a"]
+    assert calls == ["a", "a"]
+
+
+def test_cache_hash_keys(tmp_path: Any) -> None:
+    cache_name = str(tmp_path / "cache.json")
+    line = "Lisa balloon drop off " * 20
+    hashed_cache = Cache(cache_name, compact_after=1, hash_keys=True)
+    shout = hashed_cache.with_cache(str.upper)
+    with hashed_cache:
+        shout(line)
+        hashed_cache.compaction.join()
+        assert hashed_cache.get(line, "upper") == line.upper()
+    ((entry_key, _),) = Snapshot(hashed_cache.snapshot_name)
+    assert entry_key == (hash_key(line) + "\0upper").encode("utf-8")
+    assert len(hash_key(line)) == len(hash_key("")) == 17
+    # and texts aren't found by digest without hash_keys
+    verbatim_cache = Cache(cache_name)
+    verbatim_cache.load()
+    with pytest.raises(KeyError):
+        verbatim_cache.get(line, "upper")
+
+
+@pytest.mark.usefixtures("stats")
+def test_init_worker_detaches_log(monkeypatch: Any, tmp_path: Any) -> None:
+    forked_cache = Cache(str(tmp_path / "cache.json"), compact_after=1)
+    echo = forked_cache.with_cache(lambda x: x)
+    monkeypatch.setattr(extract_info, "cache", forked_cache)
+    monkeypatch.setattr(nltk_models.models, "offline", nltk_models.models.offline)
+    with forked_cache:
+        # as if forked from here
+        extract_info.init_worker()
+        echo("a")
+        echo("b")
+        assert forked_cache.compaction is None
+        assert forked_cache.pop_new_entries() == {
+            "a": {"<lambda>": "a"},
+            "b": {"<lambda>": "b"},
+        }
+    # only the parent writes them, once they're merged
+    assert os.path.getsize(forked_cache.log_name) == 0
+
+
+@pytest.mark.usefixtures("stats")
+def test_init_worker_cache_settings(monkeypatch: Any, tmp_path: Any) -> None:
+    parent_cache = Cache(
+        str(tmp_path / "cache.json"),
+        compact_after=7,
+        max_entries=5,
+        eviction=Eviction.per_function,
+        hash_keys=True,
+    )
+    # a spawned worker starts from a cache with the defaults
+    worker_cache = Cache()
+    monkeypatch.setattr(extract_info, "cache", worker_cache)
+    monkeypatch.setattr(nltk_models.models, "offline", nltk_models.models.offline)
+    extract_info.init_worker(cache_settings=parent_cache.settings())
+    assert worker_cache.settings() == parent_cache.settings()
+    assert worker_cache.log_name == parent_cache.log_name
+    assert worker_cache.loaded
+
+
+def test_snapshot_shared_values(tmp_path: Any) -> None:
+    names = ["Lisa", "Planet Fitness", "McCall"]
+    entries = {str(i): {"f": names, "g": names, "h": []} for i in range(10)}
+    shared_name = str(tmp_path / "shared.snapshot")
+    write_snapshot(shared_name, entries_to_records(entries))
+    snapshot = Snapshot(shared_name)
+    assert all(snapshot.get(str(i), "g") == names for i in range(10))
+    assert dict(snapshot) == dict(entries_to_records(entries))
+    value_size = len(json.dumps(names))
+    unshared_size = sum(
+        record_size(entry_key, len(value))
+        for entry_key, value in entries_to_records(entries)
+    )
+    shared_size = snapshot.index_offset - Snapshot.HEADER.size
+    # names is only written once
+    assert shared_size == unshared_size - 19 * (value_size - Snapshot.SHARED_VALUE.size)
+
+
+def test_cache_fingerprints(tmp_path: Any) -> None:
+    cache_name = str(tmp_path / "cache.json")
+    calls: List[str] = []
+
+    def run(generation: int) -> None:
+        fingerprint_cache = Cache(cache_name)
+        if generation == 1:
+
+            def double(text: str) -> str:
+                calls.append("double")
+                return text * 2
+
+        else:
+
+            def double(text: str) -> str:
+                calls.append("double")
+                return text + text
+
+        def shout(text: str) -> str:
+            calls.append("shout")
+            return text.upper()
+
+        cached_double = fingerprint_cache.with_cache(double)
+        cached_shout = fingerprint_cache.with_cache(shout)
+        with fingerprint_cache:
+            assert cached_double("a") == "aa"
+            assert cached_shout("a") == "A"
+
+    run(1)
+    run(1)
+    assert calls == ["double", "shout"]
+    # only the function that changed is recomputed
+    run(2)
+    assert calls == ["double", "shout", "double"]
+
+
+def test_fingerprint() -> None:
+    def compose(f: Callable, g: Callable) -> Callable:
+        return lambda x: f(g(x))
+
+    def first(x: str) -> str:
+        return x[0]
+
+    first_again = first
+
+    def first(x: str) -> str:  # type: ignore # pylint: disable=function-redefined
+        # same code, different comments
+        return x[0]
+
+    def last(x: str) -> str:
+        return x[-1]
+
+    assert fingerprint(first) == fingerprint(first_again)
+    assert fingerprint(first) != fingerprint(last)
+    assert fingerprint(compose(str.upper, first)) == fingerprint(
+        compose(str.upper, first_again)
+    )
+    assert fingerprint(compose(str.upper, first)) != fingerprint(
+        compose(str.upper, last)
+    )
+    assert fingerprint(compose(str.upper, first)) != fingerprint(
+        compose(str.lower, first)
+    )
+
+
+def test_fingerprint_globals(monkeypatch: Any) -> None:
+    before = fingerprint(strategies.only_alpha)
+    # a constant analyze reads
+    monkeypatch.setattr(strategies, "PUNCTUATION_TO_LETTERS", str.maketrans("-", "a"))
+    assert fingerprint(strategies.only_alpha) != before
+    monkeypatch.undo()
+    assert fingerprint(strategies.only_alpha) == before
+
+    # analyze itself, behind lru_cache
+    def analyze(text: str) -> Any:
+        return strategies.analyze.__wrapped__(text.strip())  # type: ignore
+
+    analyze.__module__ = strategies.__name__
+    monkeypatch.setattr(strategies, "analyze", lru_cache(maxsize=256)(analyze))
+    assert fingerprint(strategies.only_alpha) != before
+
+
+def test_snapshot(tmp_path: Any) -> None:
+    snapshot_name = str(tmp_path / "cache.json.snapshot")
+    entries = {str(i): {"f": [str(i)], "g": i} for i in range(100)}
+    write_snapshot(snapshot_name, entries_to_records(entries))
+    snapshot = Snapshot(snapshot_name)
+    assert snapshot.get("42", "f") == ["42"]
+    assert snapshot.get("99", "g") == 99
+    with pytest.raises(KeyError):
+        snapshot.get("100", "f")
+    with pytest.raises(KeyError):
+        snapshot.get("42", "h")
+    assert len(list(snapshot)) == 200
+
+
 # strategies
 
 
@@ -51,9 +377,260 @@ def test_every_name() -> None:
     )
 
 
+def test_analyze() -> None:
+    line = "3/14 Planet Fitness McCall ELISEVER 603-750-0001 X-ray Лена"
+    analysis = strategies.analyze(line)
+    assert strategies.analyze(line) is analysis
+    assert strategies.all_capitalized_extract_names(line) == [
+        "Planet",
+        "Fitness",
+        "McCall",
+        "Xray",
+        "Лена",
+    ]
+    assert strategies.only_alpha.__wrapped__(line) == (  # type: ignore
+        "Planet Fitness McCall ELISEVER X-ray Лена"
+    )
+    assert analysis.nonlatin
+    assert analysis.printable == line[: -len(" Лена")] + " "
+
+
+def test_language_client() -> None:
+    with LanguageStub(latency=0.2) as stub:
+        client = LanguageClient(discovery_url=stub.discovery_url, max_workers=8)
+        response = client.analyze_entities("Call Bob at 555")
+        assert [entity["name"] for entity in response["entities"]] == ["Call", "Bob"]
+        start = time.perf_counter()
+        responses = list(client.analyze_entities_many(["Ann", "Bo", "Cy"] * 3))
+        # all 9 requests were in flight at once instead of taking 9 * 0.2s
+        assert time.perf_counter() - start < 0.2 * 5
+        assert [response["entities"][0]["name"] for response in responses] == [
+            "Ann",
+            "Bo",
+            "Cy",
+        ] * 3
+
+
+def test_language_client_errors() -> None:
+    with LanguageStub(errors=[429, 503]) as stub:
+        client = LanguageClient(
+            discovery_url=stub.discovery_url, max_retries=2, backoff=0.01
+        )
+        assert client.analyze_entities("Ann")["entities"][0]["name"] == "Ann"
+        assert len(stub.requests) == 3
+        stub.errors.extend([503, 503, 503])
+        with pytest.raises(Unavailable):
+            client.analyze_entities("Bo")
+        # remembered as failing without asking again, but only for that text
+        with pytest.raises(Unavailable):
+            client.analyze_entities("Bo")
+        assert len(stub.requests) == 6
+        client.analyze_entities("Cy")
+        client.failures.clear()
+        client.analyze_entities("Bo")
+        assert len(stub.requests) == 8
+
+
+def test_language_client_coalesces() -> None:
+    with LanguageStub(latency=0.2) as stub:
+        client = LanguageClient(discovery_url=stub.discovery_url)
+        client.analyze_entities("warm up")
+        threads = [
+            threading.Thread(target=client.analyze_entities, args=("Ann",))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(stub.requests) == 2
+
+
+def test_rate_limiter() -> None:
+    limiter = RateLimiter(rate=20, burst=2)
+    start = time.perf_counter()
+    for _ in range(6):
+        limiter.acquire()
+    # 2 at once, then one every 1/20s
+    assert 0.15 < time.perf_counter() - start < 0.5
+
+
+def test_google_errors(monkeypatch: Any) -> None:
+    with LanguageStub(errors=[400, 403]) as stub:
+        monkeypatch.setattr(
+            language_api, "client", LanguageClient(discovery_url=stub.discovery_url)
+        )
+        # rejected for the text, so there's no point asking again
+        assert strategies.google_names("Ann") == []
+        # but e.g. billing isn't about the text, so nothing should be cached
+        with pytest.raises(HttpError):
+            strategies.google_names("Ann")
+        assert strategies.google_names("Ann") == ["Ann"]
+
+
+def test_google_extract_names_packed(monkeypatch: Any) -> None:
+    texts = ["Ann and Bob Smith", "", "no names", "Лена Cy"]
+    with LanguageStub() as stub:
+        monkeypatch.setattr(
+            language_api, "client", LanguageClient(discovery_url=stub.discovery_url)
+        )
+        packed = strategies.google_extract_names_packed(texts)
+        assert len(stub.requests) == 1
+    # the stub sees "Ann" and "Bob Smith" as separate names
+    assert packed == [["Ann", "Bob", "Smith"], [], [], ["Cy"]]
+    with LanguageStub(errors=[400, 400]) as stub:
+        monkeypatch.setattr(
+            language_api, "client", LanguageClient(discovery_url=stub.discovery_url)
+        )
+        # the pack is rejected, then each text is sent alone and only one is
+        packed = strategies.google_extract_names_packed(["Ann", "Bob", "Cy"])
+        assert len(stub.requests) == 4
+        assert packed == [[], ["Bob"], ["Cy"]]
+    assert list(strategies.pack_texts(["aaa", "bb", "c"], 7)) == [["aaa", "bb"], ["c"]]
+
+
+@pytest.mark.skipif(
+    not all(map(nltk_models.is_installed, nltk_models.PACKAGES.values())),
+    reason="NLTK models aren't installed",
+)
+def test_nltk_extract_names_batch() -> None:
+    texts = ["Call Bob Smith. Then Alice.", "", "no names here", LINE]
+    batch = strategies.nltk_extract_names_batch.__wrapped__(texts)  # type: ignore
+    singles = [strategies.nltk_extract_names.__wrapped__(text) for text in texts]
+    assert list(map(sorted, batch)) == list(map(sorted, singles))
+
+
+def test_offline_models(monkeypatch: Any) -> None:
+    monkeypatch.setattr(nltk_models, "PACKAGES", {"no_such_model": "corpora/nope"})
+    offline_models = nltk_models.Models(offline=True)
+    with pytest.raises(nltk_models.ModelsMissing, match="no_such_model"):
+        offline_models.check()
+    with pytest.raises(nltk_models.ModelsMissing, match="no_such_model"):
+        offline_models.warm_up()
+    assert not offline_models.loaded
+    # downloading is left for when they're used
+    nltk_models.Models().check()
+
+
+def test_no_models_without_names(monkeypatch: Any) -> None:
+    def missing(*args: Any) -> None:
+        raise nltk_models.ModelsMissing("not needed")
+
+    monkeypatch.setattr(nltk_models.models, "loaded", False)
+    monkeypatch.setattr(nltk_models.models, "load", missing)
+    monkeypatch.setattr(ambiguous_words, "build", missing)
+    for threads, batch_size in [(1, 0), (2, 0), (1, 2)]:
+        entries = extract_info.extract_entries(
+            ["hello world"], threads=threads, batch_size=batch_size
+        )
+        assert [entry["names"] for entry in entries] == [["skipped"]]
+
+
+def test_ambiguous_words(tmp_path: Any, monkeypatch: Any) -> None:
+    words_file = str(tmp_path / "ambiguous_words.txt")
+    ambiguous_words.save(["bill", "rose"], words_file)
+    assert ambiguous_words.ambiguous_words(words_file) == {"bill", "rose"}
+    # not quietly built with WordNet mid-run
+    monkeypatch.setattr(ambiguous_words, "build", lambda: frozenset(["bill"]))
+    with pytest.raises(
+        ambiguous_words.AmbiguousWordsMissing, match="python -m ambiguous_words"
+    ):
+        ambiguous_words.ambiguous_words(str(tmp_path / "missing.txt"))
+    monkeypatch.setattr(
+        strategies, "ambiguous_words", lambda: frozenset(["bill", "rose"])
+    )
+    assert strategies.remove_synonyms(["Bill Smith", "Rose", "Ada Lovelace"]) == [
+        "Ada Lovelace"
+    ]
+
+
+@pytest.mark.skipif(
+    not nltk_models.is_installed(nltk_models.WORDNET["wordnet"]),
+    reason="WordNet isn't installed",
+)
+def test_ambiguous_words_match_wordnet() -> None:
+    wordnet = nltk_models.models.wordnet()
+    ambiguous = ambiguous_words.build()
+    for word in ["bill", "bills", "geese", "rose", "lovelace", "dogs", "smith"]:
+        assert (word in ambiguous) == (len(wordnet.synsets(word)) > 1), word
+
+
+def test_compose_refiners() -> None:
+    calls: List[str] = []
+
+    def refiner(name: str, keep: Callable[[str], bool]) -> Callable:
+        def remove(names: List[str]) -> List[str]:
+            calls.append(name)
+            return list(filter(keep, names))
+
+        remove.__name__ = name
+        return remove
+
+    short = refiner("short", lambda name: len(name) > 2)
+    title = refiner("title", str.istitle)
+    ascii_ = refiner("ascii", str.isascii)
+    names = ["Al", "Bob Smith", "bob", "Zoë", "Eve Adams"]
+    composed = [
+        strategies.compose_refiners(short, ascii_),
+        strategies.compose_refiners(title, ascii_),
+        strategies.compose_refiners(short, title, ascii_),
+    ]
+    assert composed[0].__name__ == "short_ascii"
+    assert [refine(names) for refine in composed] == [
+        ["Bob Smith", "bob", "Eve Adams"],
+        ["Al", "Bob Smith", "Eve Adams"],
+        ["Bob Smith", "Eve Adams"],
+    ]
+    # ascii ran once for all of them, and title once for the last two
+    assert calls == ["ascii", "short", "title", "short"]
+
+
 # extract_info
 
 
+def test_min_phone_digits() -> None:
+    from phonenumbers import PhoneMetadata
+    from phonenumbers.phonenumberutil import (
+        SUPPORTED_REGIONS,
+        COUNTRY_CODES_FOR_NON_GEO_REGIONS,
+    )
+
+    metadata = [
+        *map(PhoneMetadata.metadata_for_region, SUPPORTED_REGIONS),
+        *map(
+            PhoneMetadata.metadata_for_nongeo_region, COUNTRY_CODES_FOR_NON_GEO_REGIONS
+        ),
+    ]
+    assert extract_info.MIN_PHONE_DIGITS <= min(
+        len(str(region.country_code)) + length
+        for region in metadata
+        for length in region.general_desc.possible_length
+        if length > 0
+    )
+
+
+def test_extract_contacts() -> None:
+    lines = [
+        LINE,
+        "12/31 $40 paid",
+        "call +43 1 5331234 or 603-750-0001 x 119",
+        "abc6037500001 fax",
+        "a@b.com 12",
+        "(603) 750-0001",
+        "６０３-７５０-０００１",
+    ]
+    for line in lines:
+        phones = [
+            format_number(match.number, PhoneNumberFormat.INTERNATIONAL)
+            for match in PhoneNumberMatcher(line, "US")
+        ]
+        assert extract_info.extract_contacts(line) == (
+            extract_info.EMAIL_RE.findall(line),
+            phones,
+        )
+    assert extract_info.extract_contacts("12/31 $40 paid") == ([], [])
+
+
 def test_fuzzy_intersect() -> None:
     cases: Sequence[Sequence[List]] = [
         (["Bob", "Miller"], ["Miller"], ["Miller"]),
@@ -68,6 +645,18 @@ def test_fuzzy_intersect() -> None:
     ]
     for left, right, expected in cases:
         assert extract_info.fuzzy_intersect(left, right) == expected
+    # way past the recursion limit of the old version
+    left, right, expected = cases[-1]
+    assert extract_info.fuzzy_intersect(left * 1000, right * 1000) == expected
+
+
+def test_fuzzy_intersect_index(monkeypatch: Any) -> None:
+    left = ["Ariel Kochi", "Bob", "Pierre", "Kochi", "Miller", "Bo", "Marion"]
+    right = ["Ariel", "Kochi", "Pierre Kochi", "Bob Miller", "Bo", "Eve"]
+    expected = ["Ariel Kochi", "Bob Miller", "Pierre Kochi"]
+    assert extract_info.fuzzy_intersect(left, right) == expected
+    monkeypatch.setattr(extract_info, "FUZZY_INDEX_MIN_NAMES", 0)
+    assert extract_info.fuzzy_intersect(left, right) == expected
 
 
 LINE = "12/31 -- Lisa balloon drop -- off 617.555.5555 - paid, check deposited"
@@ -80,6 +669,123 @@ def test_no_google() -> None:
     assert actual == expected
 
 
+ENTRIES = [
+    {"line": ["a"], "emails": ["a@b.c"], "phones": [], "names": ["A"]},
+    {"line": ["b"], "emails": [], "phones": [], "names": ["skipped"]},
+    {"line": ["c"], "emails": ["c@d.e"], "phones": ["+1 2"], "names": []},
+]
+
+
+def test_stream_entries() -> None:
+    saved, streamed = io.StringIO(), io.StringIO()
+    extract_info.save_entries(ENTRIES, saved)
+    counts = extract_info.count_entry_types(
+        extract_info.stream_entries(iter(ENTRIES), streamed)
+    )
+    assert saved.getvalue() == streamed.getvalue()
+    assert counts == extract_info.analyze_metrics(ENTRIES)[1]
+
+
+def test_entry_writer() -> None:
+    entries = [extract_info.Entry.of(entry) for entry in ENTRIES]
+    assert entries == ENTRIES
+    assert entries[2]["line"] == ["c"] and dict(entries[2]) == ENTRIES[2]
+    assert list(entries[2].rows()) == [("c", "c@d.e", "+1 2", "")]
+
+    class CountingWrites(io.StringIO):
+        writes = 0
+
+        def write(self, text: str) -> int:
+            self.writes += 1
+            return super().write(text)
+
+    out_file = CountingWrites()
+    with extract_info.EntryWriter(out_file, batch_size=2) as writer:
+        for entry in entries * 2:
+            writer.write(entry)
+    # header and a row for each entry, in 3 writes
+    assert out_file.writes == 3
+    assert out_file.getvalue().splitlines() == [
+        "line,emails,phones,names",
+        *["a,a@b.c,,A", "b,,,skipped", "c,c@d.e,+1 2,"] * 2,
+    ]
+    jsonl = io.StringIO()
+    extract_info.save_entries(ENTRIES, jsonl, extract_info.OutputFormat.jsonl)
+    loaded = list(map(json.loads, jsonl.getvalue().splitlines()))
+    assert loaded[0] == {"line": "a", "emails": ["a@b.c"], "phones": [], "names": ["A"]}
+    assert list(map(extract_info.Entry.from_json, loaded)) == ENTRIES
+
+
+@pytest.mark.usefixtures("stats")
+def test_incremental_main(monkeypatch: Any, tmp_path: Any) -> None:
+    entries = {entry["line"][0]: entry for entry in ENTRIES}
+    extracted: List[str] = []
+
+    def extract_entries(lines: Iterable[str], *args: Any) -> Iterator[Any]:
+        for line in lines:
+            extracted.append(line)
+            yield entries[line]
+
+    monkeypatch.setattr(extract_info, "extract_entries", extract_entries)
+    monkeypatch.setattr(extract_info, "cache", Cache(str(tmp_path / "cache.json")))
+    in_name, out_name = str(tmp_path / "trello.csv"), str(tmp_path / "info.csv")
+
+    def run(lines: List[str]) -> Any:
+        with open(in_name, "w", encoding="utf-8") as in_file:
+            in_file.write("\n".join(["line"] + lines))
+        counts = extract_info.incremental_main(
+            in_name=in_name,
+            out_name=out_name,
+            checkpoint_name=str(tmp_path / "checkpoint"),
+        )
+        saved = io.StringIO()
+        extract_info.save_entries([entries[line] for line in lines], saved)
+        with open(out_name, encoding="utf-8") as out_file:
+            assert out_file.read() == saved.getvalue().replace("\r\n", "\n")
+        assert counts == extract_info.count_entry_types(map(entries.get, lines))
+        return extracted
+
+    assert run(["a", "b"]) == ["a", "b"]
+    # appended
+    assert run(["a", "b", "c", "c"]) == ["a", "b", "c"]
+    # rewritten
+    assert run(["c", "a"]) == ["a", "b", "c"]
+    # removed rows are forgotten
+    assert run(["b", "a"]) == ["a", "b", "c", "b"]
+
+
+@pytest.mark.usefixtures("stats")
+def test_extract_info_pipelined() -> None:
+    requested: Dict[str, List[str]] = {}
+
+    def google(text: str) -> List[str]:
+        # a cached request
+        if text not in requested:
+            time.sleep(0.05)
+            requested[text] = text.split()[:2]
+        return requested[text]
+
+    def crude(text: str) -> List[str]:
+        return text.split()[:2]
+
+    stages: Any = ([google], [crude], [keep])
+    lines = [f"Ann{i} Lee ann{i}@example.com" for i in range(8)] + ["no contacts"]
+
+    async def extract_all() -> List[Any]:
+        entries = extract_info.extract_info_pipelined(lines, 8, 4, stages)
+        return [entry async for entry in entries]
+
+    start = time.perf_counter()
+    entries = asyncio.run(extract_all())
+    # the requests overlapped, even though only 4 lines were in flight at once
+    assert time.perf_counter() - start < 0.05 * len(requested)
+    assert len(requested) == 8
+    # the requests' time counts toward google's tries, which are counted once
+    google_record = extract_info.strategy_stats.records["google"]
+    assert google_record.tried == 8 and google_record.time >= 0.05 * 8
+    assert entries == [extract_info.extract_info(line, stages=stages) for line in lines]
+
+
 def test_generate_graph() -> None:
     graph = generate_graph([["", "a", "A"], ["", "b", "B"]])
     actual = {state: transition for state, transition in graph}
@@ -92,3 +798,128 @@ def test_generate_graph() -> None:
         (2, 1): {"B": (2, 2)},
     }
     assert actual == expected
+
+
+def test_strategy_graph() -> None:
+    graph = StrategyGraph([["", "a", "A"], ["", "b"], ["", "c", "C"]])
+    # stage 1 has nothing left to skip to
+    assert graph[(1, 1, 0)] == {"c": (1, 1, 1)}
+    assert graph[(1, 1, 2)] == {"A": (2, 0, 0)}
+    assert dict(graph) == {
+        (0, 0, 0): {"a": (1, 0, 0)},
+        (1, 0, 0): {"b": (1, 1, 0), "A": (2, 0, 0)},
+        (1, 1, 0): {"c": (1, 1, 1)},
+        (1, 1, 1): {"C": (1, 1, 2)},
+        (1, 1, 2): {"A": (2, 0, 0)},
+        (2, 0, 0): {"b": (2, 1, 0)},
+        (2, 1, 0): {"c": (2, 1, 1)},
+        (2, 1, 1): {"C": (2, 1, 2)},
+    }
+    assert (2, 1, 2) not in graph
+    # 100 ** 3 combinations, but only the states on the way are worked out
+    stages = [[""] + [f"{stage}{i}" for i in range(99)] for stage in "gcr"]
+    graph = StrategyGraph(stages)
+    trace = ["g0", "c0", "c1", "c2", "r0", "r1"]
+    assert walk_graph(trace, (0, 0, 0), graph) == (1, 3, 2)
+    assert len(graph.transitions) < 20
+    with pytest.raises(Exception, match="not r2"):
+        walk_graph(["g0", "r2"], (0, 0, 0), graph)
+
+
+def test_extract_names_lazy_stages() -> None:
+    def extractor(name: str, names: List[str]) -> Any:
+        def extract(text: str) -> List[str]:
+            return names
+
+        extract.__name__ = name
+        return extract
+
+    logger = Logger("test_extract_names_lazy_stages")
+    stages = [
+        [extractor("g1", ["Zed"]), extractor("g2", ["Ann Lee"])],
+        [extractor("c1", ["Bob"]), extractor("c2", ["Ann", "Lee"])],
+        [keep],
+    ]
+    logged = tuple([logger.logged(strategy) for strategy in stage] for stage in stages)
+    # g2 is paired with the crude extractions even though g1 used them up
+    assert extract_info.extract_names("", 1, 1, logged) == ["Ann Lee"]  # type: ignore
+    trace = logger.stream.getvalue().split()
+    # and c1, c2 and keep on [] aren't run again for it
+    assert trace == ["g1", "c1", "keep", "c2", "g2", "keep"]
+    names = [[""] + [strategy.__name__ for strategy in stage] for stage in stages]
+    graph = dict(generate_graph(names))
+    assert walk_graph(trace, (0, 0, 0), graph) == (2, 2, 1)
+    with pytest.raises(Exception, match="not c1"):
+        walk_graph(["g1", "c1", "c1"], (0, 0, 0), graph)
+
+
+def test_adaptive_order(stats: strategy_stats.StrategyStats, tmp_path: Any) -> None:
+    def slow(text: str) -> List[str]:
+        time.sleep(0.01)
+        return ["Bob"]
+
+    def fast(text: str) -> List[str]:
+        return ["Bob"]
+
+    stages: Any = ([slow, fast], [fast], [keep])
+    assert extract_info.extract_names("", 1, 1, stages) == ["Bob"]
+    # fast was only tried as the crude extractor
+    assert [stats.records[name].accepted for name in ["slow", "fast", "keep"]] == [
+        1,
+        1,
+        1,
+    ]
+    # deterministic unless adaptive
+    assert stats.order(stages[0]) == [slow, fast]
+    stats.adaptive = True
+    assert stats.order(stages[0]) == [fast, slow]
+    stats.save()
+    reloaded = strategy_stats.StrategyStats(str(tmp_path / "strategies"))
+    reloaded.load()
+    assert reloaded.records == stats.records
+
+
+def test_histogram() -> None:
+    histogram = instrumentation.Histogram()
+    for millisecond in range(1, 101):
+        histogram.add(millisecond / 1000)
+    assert histogram.count == 100
+    # within a bucket, which is 19% wide
+    assert 0.05 <= histogram.percentile(0.5) < 0.05 * 1.19
+    assert 0.099 <= histogram.percentile(0.99) <= 0.1
+    assert histogram.percentile(1) == histogram.max == 0.1
+    other = instrumentation.Histogram()
+    other.add(1)
+    histogram.merge(other)
+    assert histogram.to_json()["max"] == 1
+    assert histogram.to_json()["count"] == 101
+
+
+def test_instruments(monkeypatch: Any, tmp_path: Any) -> None:
+    out = io.StringIO()
+    progress = instrumentation.Progress(4, interval=3600, out=out)
+    for _ in range(4):
+        progress.update()
+    # rate limited
+    assert out.getvalue() == ""
+    progress.finish()
+    assert out.getvalue().startswith("\r4/4 lines, ")
+    assert out.getvalue().endswith(", ETA 0:00\n")
+
+    instruments = instrumentation.Instruments(progress_interval=0, profile_every=2)
+    monkeypatch.setattr(extract_info, "instruments", instruments)
+    monkeypatch.setattr(strategy_stats, "instruments", instruments)
+    stages: Any = ([lambda text: ["Bob"]], [], [])
+    lines = ["Bob bob@example.com", "no contacts", "Bob 617.555.1234"]
+    for line in instruments.track(lines, len(lines)):
+        extract_info.extract_info(line, stages=stages)
+    # the line without contacts isn't extracted, the second one that is is profiled
+    assert instruments.timings["line"].count == 2
+    assert instruments.timings["<lambda>"].count == 2
+    instruments.export(str(tmp_path / "report.json"), extra={"answer": 42})
+    with open(tmp_path / "report.json") as report_file:
+        report = json.load(report_file)
+    assert report["progress"]["lines"] == 3
+    assert report["profile"]["lines"] == 1
+    assert report["profile"]["functions"]
+    assert report["extra"] == {"answer": 42}